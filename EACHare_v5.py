@@ -8,60 +8,713 @@
 
 import sys
 import os
+import atexit
 import socket
 import threading
 import base64
+import hashlib
+import json
+import struct
 import time
+import collections
+import contextlib
+import select
+import selectors
+import asyncio
+import queue
+import random
+import re
+from array import array
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as PrazoEsgotado, as_completed
 
-class Clock:
+ONLINE = "ONLINE"
+OFFLINE = "OFFLINE"
+ESTADOS = {ONLINE: ONLINE, OFFLINE: OFFLINE}  # devolve sempre a mesma string para cada estado
+ESTADOS_POR_CODIGO = (OFFLINE, ONLINE)  # estado guardado como um byte na TabelaPeers
+CODIGOS_ESTADO = {estado: codigo for codigo, estado in enumerate(ESTADOS_POR_CODIGO)}
+
+TAMANHO_CHUNK = 1024 * 1024  # bytes por chunk pedido em cada DL
+MAX_DOWNLOADS_PARALELOS = 4  # chunks baixados ao mesmo tempo
+TIMEOUT_CONEXAO = 5  # segundos para conectar e esperar resposta de um peer
+TEMPO_OCIOSO_POOL = 20  # conexões paradas no pool há mais tempo que isso são fechadas
+TEMPO_OCIOSO_SERVIDOR = 30  # o servidor fecha conexões sem mensagens por esse tempo
+LIMITE_LINHA_ASYNC = 1024 * 1024  # maior linha de mensagem aceita pelo servidor asyncio
+MODOS_SERVIDOR = ("threads", "asyncio", "pool")
+TRABALHADORES_SERVIDOR = 32  # threads fixas do modo pool
+TAMANHO_FILA_SERVIDOR = 64  # conexões com mensagem chegada esperando um trabalhador livre
+ESPERA_FILA_SERVIDOR = 0.5  # segundos segurando uma conexão antes de responder BUSY
+TENTATIVAS_OCUPADO = 3  # novas tentativas do cliente quando o peer responde BUSY
+ESPERA_OCUPADO = 0.5  # segundos entre tentativas, dobrando a cada BUSY
+MAX_CONSULTAS_PARALELAS = 16  # peers consultados ao mesmo tempo em GET_PEERS e LS
+PRAZO_DESCOBERTA = 8  # segundos para a rodada inteira de GET_PEERS
+PRAZO_BUSCA = 6  # segundos esperando respostas de LS antes de mostrar o menu de download
+TTL_BUSCA = 30  # segundos em que o LS_LIST guardado de um peer é usado sem consultar a rede
+TTL_INUNDACAO = 4  # saltos que um QUERY percorre a partir de quem iniciou a busca
+PRAZO_INUNDACAO = 6  # segundos esperando QUERY_HIT depois de disparar a busca
+MAX_CONSULTAS_VISTAS = 4096  # ids de QUERY lembrados para descartar cópias repetidas
+INTERVALO_HEARTBEAT = 15  # segundos entre as rodadas do heartbeat automático (0 desliga)
+FATOR_SUSPEITA = 3  # intervalos de heartbeat sem notícia de um peer ONLINE até marcá-lo OFFLINE
+INTERVALO_ANTI_ENTROPIA = 10  # segundos entre trocas de alterações de peers com um vizinho sorteado (0 desliga)
+MAX_ALTERACOES = 4096  # alterações de peers lembradas; GET_PEERS de uma versão mais antiga recebe a tabela inteira
+INTERVALO_INDICE = 2  # segundos entre as varreduras do diretório compartilhado
+ORCAMENTO_CACHE_CHUNKS = 64 * 1024 * 1024  # bytes de chunks em base64 guardados para DL repetidos
+INTERVALO_HASHES = 5  # segundos entre as rodadas do cálculo de hashes em segundo plano
+ARQUIVO_HASHES = ".eachare_hashes.json"  # cache dos manifestos, dentro do diretório compartilhado
+SUFIXO_PARCIAL = ".part"  # download em andamento
+SUFIXO_DIARIO = ".part.chunks"  # chunks já gravados no .part, um índice por linha
+MAX_LOTE = 64  # mensagens aceitas num único BATCH
+MODOS_PROTOCOLO = ("texto", "binario")
+MODOS_RELOGIO = ("lamport", "hlc")
+BITS_CONTADOR_HLC = 16  # carimbo HLC num inteiro: milissegundos nos bits altos, contador nos 16 baixos
+TIMEOUT_NEGOCIACAO = 1  # segundos esperando um peer que ainda não anunciou o que atende; peers antigos não respondem
+INTERVALO_SONDAGEM = 300  # segundos até sondar de novo um peer que não respondeu à negociação
+CAPACIDADES = ("BATCH", "KEEPALIVE")  # anunciadas na negociação: lotes e várias mensagens por conexão
+MARCA_BINARIA = 0xEA  # primeiro byte de um quadro binário (uma mensagem em texto começa pelo endereço)
+# Quadro binário: marca, código do tipo, clock, tamanho da origem, número de argumentos e tamanho
+# do corpo. O corpo traz a origem, o nome do tipo (só quando o código é 0) e cada argumento
+# precedido do seu tamanho em 4 bytes.
+CABECALHO_BINARIO = struct.Struct("!BBQBHI")
+TAMANHO_ARGUMENTO = struct.Struct("!I")
+TIPOS_BINARIOS = (
+    None, "HELLO", "HELLO_BIN", "GET_PEERS", "PEER_LIST", "PEER_DELTA", "PEER_PUSH", "LIST_FILES",
+    "FILE_LIST", "BYE", "LS", "LS_LIST", "LS_LIST_V", "LS_NOT_MODIFIED", "SEARCH", "SEARCH_LIST",
+    "QUERY", "QUERY_HIT", "HASH", "HASH_LIST", "HASH_NONE", "DL", "FILE", "FILE_RAW", "BUSY",
+    "BATCH", "BATCH_REPLY", "ACK", "HELLO_TEXTO",
+)
+CODIGOS_TIPO = {tipo: codigo for codigo, tipo in enumerate(TIPOS_BINARIOS) if tipo is not None}
+
+class SaidaAssincrona:
+    # Linhas de log escritas por uma thread própria: quem registra só enfileira e segue,
+    # sem esperar o terminal. O que estiver pendente na saída do programa é escrito antes.
     def __init__(self):
+        self.fila = queue.SimpleQueue()
+        threading.Thread(target=self.escrever_pendentes, daemon=True).start()
+        atexit.register(self.descarregar)
+
+    def registrar(self, texto):
+        self.fila.put(texto)
+
+    def descarregar(self, linhas=None):
+        # Escreve de uma vez tudo o que já estiver na fila
+        linhas = linhas or []
+        try:
+            while True:
+                linhas.append(self.fila.get_nowait())
+        except queue.Empty:
+            pass
+        if linhas:
+            sys.stdout.write("\n".join(linhas) + "\n")
+            sys.stdout.flush()
+
+    def escrever_pendentes(self):
+        while True:
+            self.descarregar([self.fila.get()])
+
+class Clock:
+    # A seção crítica é só a conta; o novo valor é devolvido a quem chamou (ler self.valor
+    # depois pode pegar o incremento de outra thread) e o aviso sai fora do lock, por registrar
+    def __init__(self, registrar=print):
         self.valor = 0
         self.lock = threading.Lock()
+        self.registrar = registrar
 
     def incrementar(self):
         with self.lock:
             self.valor += 1
-            print(f"=> Atualizando relogio para {self.valor}")
-            return self.valor
+            valor = self.valor
+        self.registrar(f"=> Atualizando relogio para {valor}")
+        return valor
 
     def atualizar(self, valor_recebido):
         with self.lock:
             self.valor = max(self.valor, valor_recebido) + 1
-            print(f"=> Atualizando relogio para {self.valor}")
-            return self.valor
+            valor = self.valor
+        self.registrar(f"=> Atualizando relogio para {valor}")
+        return valor
+
+class RelogioHibrido:
+    # Hybrid logical clock: carimbos que acompanham o tempo físico (ms) mas nunca andam para
+    # trás e respeitam causalidade entre peers. Cada carimbo é um único inteiro,
+    # (milissegundos << BITS_CONTADOR_HLC) | contador, então comparar carimbos é comparar inteiros.
+    def __init__(self):
+        self.fisico = 0
+        self.contador = 0
+        self.lock = threading.Lock()
+
+    def agora(self):
+        # Carimbo para um evento local (uma observação direta do estado de um peer)
+        fisico = time.time_ns() // 1_000_000
+        with self.lock:
+            if fisico > self.fisico:
+                self.fisico, self.contador = fisico, 0
+            else:
+                self.contador += 1
+            return self.fisico << BITS_CONTADOR_HLC | self.contador
+
+    def receber(self, carimbo):
+        # Incorpora um carimbo recebido, para que os próximos locais venham depois dele
+        fisico_recebido, contador_recebido = carimbo >> BITS_CONTADOR_HLC, carimbo & ((1 << BITS_CONTADOR_HLC) - 1)
+        fisico = time.time_ns() // 1_000_000
+        with self.lock:
+            maior = max(self.fisico, fisico_recebido, fisico)
+            if maior == self.fisico and maior == fisico_recebido:
+                self.contador = max(self.contador, contador_recebido) + 1
+            elif maior == self.fisico:
+                self.contador += 1
+            elif maior == fisico_recebido:
+                self.contador = contador_recebido + 1
+            else:
+                self.contador = 0
+            self.fisico = maior
+            return self.fisico << BITS_CONTADOR_HLC | self.contador
 
 class Peer:
-    def __init__(self, endereco, porta):
+    __slots__ = ("endereco", "porta", "estado", "relogio", "ultimo_hello", "registro", "carimbo")
+
+    def __init__(self, endereco, porta, registro=None):
         self.endereco = endereco
         self.porta = porta
-        self.estado = "OFFLINE"
+        self.estado = OFFLINE
         self.relogio = 0
         self.ultimo_hello = time.time()
+        self.registro = registro  # RegistroPeers avisado quando o estado muda
+        self.carimbo = 0  # carimbo HLC da observação que definiu o estado atual (0 fora do modo hlc)
 
-    def atualizar_estado(self, novo_estado):
-        self.estado = novo_estado
-        if novo_estado == "ONLINE":
+    def atualizar_estado(self, novo_estado, silencioso=False, observado=True):
+        # Com silencioso (trocas em segundo plano), só avisa no terminal se o estado mudou.
+        # observado=False marca um estado ouvido de outro peer, que não ganha carimbo novo.
+        anterior = self.estado
+        self.estado = ESTADOS.get(novo_estado, novo_estado)
+        if novo_estado == ONLINE:
             self.ultimo_hello = time.time()
-        print(f"Atualizando peer {self.endereco}:{self.porta} status {novo_estado}")
+        if not silencioso or anterior != self.estado:
+            print(f"Atualizando peer {self.endereco}:{self.porta} status {novo_estado}")
+        if self.registro is not None:
+            if observado and self.registro.hlc is not None:
+                # Toda observação direta é carimbada, mesmo sem mudar o estado: é ela que
+                # impede uma lista antiga de outro peer de desfazer o que acabamos de ver
+                self.carimbo = self.registro.hlc.agora()
+            if anterior != self.estado:
+                self.registro.notificar(self, anterior, self.estado)
 
     def atualizar_relogio(self, valor):
         if valor > self.relogio:
             self.relogio = valor
 
+class TabelaPeers:
+    # Peers guardados em colunas (IPv4 empacotado, porta, estado, relógio, último HELLO, carimbo HLC)
+    # em vez de um objeto por peer; endereços que não são IPv4 ficam à parte em nomes
+    def __init__(self):
+        self.ips = array("I")
+        self.portas = array("H")
+        self.estados = array("B")
+        self.relogios = array("Q")
+        self.ultimos_hello = array("d")
+        self.carimbos = array("Q")
+        self.nomes = {}
+        self.registro = None
+
+    @staticmethod
+    def chave(endereco, porta):
+        # Chave compacta do índice: IPv4 e porta num único inteiro
+        try:
+            return int.from_bytes(socket.inet_pton(socket.AF_INET, endereco), "big") << 16 | porta
+        except OSError:
+            return (endereco, porta)
+
+    def inserir(self, endereco, porta):
+        linha = len(self.portas)
+        try:
+            ip = int.from_bytes(socket.inet_pton(socket.AF_INET, endereco), "big")
+        except OSError:
+            ip = 0
+            self.nomes[linha] = endereco
+        self.ips.append(ip)
+        self.portas.append(porta)
+        self.estados.append(CODIGOS_ESTADO[OFFLINE])
+        self.relogios.append(0)
+        self.ultimos_hello.append(time.time())
+        self.carimbos.append(0)
+        return linha
+
+    def endereco(self, linha):
+        nome = self.nomes.get(linha)
+        if nome is not None:
+            return nome
+        return socket.inet_ntop(socket.AF_INET, self.ips[linha].to_bytes(4, "big"))
+
+class PeerCompacto:
+    # Visão de uma linha da TabelaPeers com a mesma interface de Peer
+    __slots__ = ("tabela", "linha")
+
+    def __init__(self, tabela, linha):
+        self.tabela = tabela
+        self.linha = linha
+
+    @property
+    def endereco(self):
+        return self.tabela.endereco(self.linha)
+
+    @property
+    def porta(self):
+        return self.tabela.portas[self.linha]
+
+    @property
+    def estado(self):
+        return ESTADOS_POR_CODIGO[self.tabela.estados[self.linha]]
+
+    @estado.setter
+    def estado(self, valor):
+        self.tabela.estados[self.linha] = CODIGOS_ESTADO[valor]
+
+    @property
+    def relogio(self):
+        return self.tabela.relogios[self.linha]
+
+    @relogio.setter
+    def relogio(self, valor):
+        self.tabela.relogios[self.linha] = valor
+
+    @property
+    def registro(self):
+        return self.tabela.registro
+
+    @property
+    def ultimo_hello(self):
+        return self.tabela.ultimos_hello[self.linha]
+
+    @ultimo_hello.setter
+    def ultimo_hello(self, valor):
+        self.tabela.ultimos_hello[self.linha] = valor
+
+    @property
+    def carimbo(self):
+        return self.tabela.carimbos[self.linha]
+
+    @carimbo.setter
+    def carimbo(self, valor):
+        self.tabela.carimbos[self.linha] = valor
+
+    atualizar_estado = Peer.atualizar_estado
+    atualizar_relogio = Peer.atualizar_relogio
+
+    def __eq__(self, outro):
+        return isinstance(outro, PeerCompacto) and outro.tabela is self.tabela and outro.linha == self.linha
+
+    def __hash__(self):
+        return hash((id(self.tabela), self.linha))
+
+class RegistroPeers:
+    # Peers conhecidos indexados por (endereco, porta); a ordem de inserção é a ordem do menu.
+    # No modo compacto os dados ficam numa TabelaPeers e cada acesso devolve um PeerCompacto.
+    # Cada peer criado ou com estado alterado recebe a próxima versão do registro, o que permite
+    # responder GET_PEERS <versao> só com as entradas que mudaram desde aquela versão. Só as
+    # MAX_ALTERACOES mais recentes são lembradas; quem pede uma versão anterior a elas recebe tudo.
+    # Com hlc (RelogioHibrido), cada estado leva o carimbo da observação que o definiu e as
+    # entradas de PEER_LIST são mescladas pelo carimbo em vez do relógio de Lamport.
+    def __init__(self, compacto=False, hlc=None):
+        self.tabela = TabelaPeers() if compacto else None
+        self.hlc = hlc
+        if self.tabela is not None:
+            self.tabela.registro = self
+        self.peers = {}
+        self.observadores = []
+        self.lock = threading.Lock()
+        self.inicio = int(time.time())  # distingue as versões de execuções diferentes do peer
+        self.versao = 0
+        self.alteracoes = collections.OrderedDict()  # chave -> versão, da alteração mais antiga à mais nova
+        self.esquecida = 0  # versão da última alteração descartada de alteracoes
+        self.versoes_vizinhos = {}  # (endereco, porta) -> última versão recebida daquele vizinho
+        # Lock próprio: alterações são marcadas por mesclar com self.lock já adquirido
+        self.lock_alteracoes = threading.Lock()
+        self.observar(lambda peer, anterior, novo: self.marcar_alteracao(peer.endereco, peer.porta))
+
+    def observar(self, funcao):
+        # funcao(peer, estado_anterior, novo_estado) é chamada a cada mudança de estado
+        self.observadores.append(funcao)
+
+    def notificar(self, peer, anterior, novo):
+        for funcao in self.observadores:
+            funcao(peer, anterior, novo)
+
+    def _chave(self, endereco, porta):
+        if self.tabela is None:
+            return (endereco, porta)
+        return TabelaPeers.chave(endereco, porta)
+
+    def _criar(self, endereco, porta):
+        self.marcar_alteracao(endereco, porta)
+        if self.tabela is None:
+            return Peer(endereco, porta, self)
+        return self.tabela.inserir(endereco, porta)
+
+    def marcar_alteracao(self, endereco, porta):
+        chave = self._chave(endereco, porta)
+        with self.lock_alteracoes:
+            self.versao += 1
+            self.alteracoes[chave] = self.versao
+            self.alteracoes.move_to_end(chave)
+            if len(self.alteracoes) > MAX_ALTERACOES:
+                _, self.esquecida = self.alteracoes.popitem(last=False)
+
+    def identificador_versao(self):
+        return f"{self.inicio}.{self.versao}"
+
+    def alteracoes_desde(self, identificador):
+        # Devolve (identificador_atual, peers alterados depois de identificador). Um identificador
+        # de outra execução deste peer, inválido ou mais antigo que as alterações lembradas
+        # recebe a tabela inteira.
+        inicio, _, versao = identificador.partition(".")
+        with self.lock_alteracoes:
+            atual = f"{self.inicio}.{self.versao}"
+            if inicio != str(self.inicio) or not versao.isdigit() or int(versao) < self.esquecida:
+                chaves = None
+            else:
+                versao = int(versao)
+                chaves = []
+                for chave, alterada in reversed(self.alteracoes.items()):
+                    if alterada <= versao:
+                        break
+                    chaves.append(chave)
+        if chaves is None:
+            return atual, list(self)
+        valores = [self.peers.get(chave) for chave in reversed(chaves)]
+        return atual, [self._peer(valor) for valor in valores if valor is not None]
+
+    def _peer(self, valor):
+        if self.tabela is None:
+            return valor
+        return PeerCompacto(self.tabela, valor)
+
+    def obter(self, endereco, porta):
+        valor = self.peers.get(self._chave(endereco, porta))
+        return None if valor is None else self._peer(valor)
+
+    def obter_ou_criar(self, endereco, porta):
+        # Devolve (peer, criado)
+        chave = self._chave(endereco, porta)
+        with self.lock:
+            valor = self.peers.get(chave)
+            if valor is not None:
+                return self._peer(valor), False
+            valor = self._criar(endereco, porta)
+            self.peers[chave] = valor
+            return self._peer(valor), True
+
+    def mesclar(self, endereco, porta, estado, relogio, carimbo=0, silencioso=False):
+        # Aplica uma entrada de PEER_LIST: peers novos entram, conhecidos só mudam se o relógio for
+        # maior. No modo hlc, entradas carimbadas só vencem uma observação com carimbo anterior,
+        # então uma lista atrasada não desfaz um estado mais recente.
+        por_carimbo = self.hlc is not None and carimbo > 0
+        chave = self._chave(endereco, porta)
+        with self.lock:
+            valor = self.peers.get(chave)
+            if valor is None:
+                valor = self._criar(endereco, porta)
+                self.peers[chave] = valor
+                peer = self._peer(valor)
+            else:
+                peer = self._peer(valor)
+                if por_carimbo and carimbo <= peer.carimbo:
+                    return
+                if not por_carimbo and relogio <= peer.relogio:
+                    return
+            # O estado veio de outro peer: não é uma observação nossa e não ganha carimbo novo.
+            # Sem carimbo na entrada fica o anterior (0 para um peer novo).
+            peer.atualizar_estado(estado, silencioso, observado=False)
+            peer.atualizar_relogio(relogio)
+            if por_carimbo:
+                # Fica o carimbo da observação original
+                peer.carimbo = carimbo
+                self.hlc.receber(carimbo)
+
+    def __iter__(self):
+        with self.lock:
+            return iter([self._peer(valor) for valor in self.peers.values()])
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __getitem__(self, indice):
+        with self.lock:
+            return self._peer(list(self.peers.values())[indice])
+
+def arquivo_interno(nome):
+    # Arquivos mantidos pelo próprio peer dentro do diretório compartilhado, que não são anunciados
+    return nome.startswith(ARQUIVO_HASHES) or nome.endswith(SUFIXO_PARCIAL) or nome.endswith(SUFIXO_DIARIO)
+
+def palavras_nome(texto):
+    # Palavras usadas na busca: trechos alfanuméricos em minúsculas ("Aula_01.pdf" -> aula, 01, pdf)
+    return re.findall(r"[^\W_]+", texto.lower())
+
+class IndiceArquivos:
+    # Cache do diretório compartilhado (nome -> tamanho, mtime) com o payload do LS_LIST já montado
+    # e um índice invertido palavra -> nomes para a busca por palavras-chave.
+    # Uma thread revarre o diretório periodicamente; LS, SEARCH e DL só consultam a memória.
+    def __init__(self, diretorio):
+        self.diretorio = diretorio
+        self.arquivos = {}
+        self.palavras = {}
+        self.versao = 0
+        self.inicio = int(time.time())  # distingue as versões de execuções diferentes do peer
+        self.carga_ls = "0"
+        self.itens_ls = ["0"]  # os mesmos itens de carga_ls, separados, para o formato binário
+        self.lock = threading.Lock()
+        self.atualizar()
+        self.manifestos = ManifestosArquivos(self)
+        self.cache_chunks = CacheChunks()
+
+    def atualizar(self):
+        # Devolve True se algo mudou desde a última varredura
+        vistos = {}
+        with os.scandir(self.diretorio) as entradas:
+            for entrada in entradas:
+                if not entrada.is_file() or arquivo_interno(entrada.name):
+                    continue
+                info = entrada.stat()
+                vistos[entrada.name] = (info.st_size, info.st_mtime_ns)
+        with self.lock:
+            if vistos == self.arquivos:
+                return False
+            palavras = {}
+            for nome in vistos:
+                for palavra in palavras_nome(nome):
+                    palavras.setdefault(palavra, set()).add(nome)
+            self.arquivos = vistos
+            self.palavras = palavras
+            self.versao += 1
+            self.itens_ls = [str(len(vistos))] + [f"{nome}:{tamanho}" for nome, (tamanho, _) in vistos.items()]
+            self.carga_ls = " ".join(self.itens_ls)
+        return True
+
+    def monitorar(self, intervalo=INTERVALO_INDICE):
+        while True:
+            time.sleep(intervalo)
+            try:
+                self.atualizar()
+            except OSError as e:
+                print(f"Erro ao varrer '{self.diretorio}': {e}")
+
+    def identificador_versao(self):
+        return f"{self.inicio}.{self.versao}"
+
+    def nomes(self):
+        return list(self.arquivos)
+
+    def buscar(self, palavras):
+        # Devolve [(nome, tamanho)] dos arquivos que contêm todas as palavras
+        with self.lock:
+            indice, arquivos = self.palavras, self.arquivos
+        nomes = None
+        for palavra in palavras:
+            encontrados = indice.get(palavra, set())
+            nomes = set(encontrados) if nomes is None else nomes & encontrados
+            if not nomes:
+                return []
+        return [(nome, arquivos[nome][0]) for nome in sorted(nomes or ())]
+
+    def ler_trecho(self, nome, inicio, comprimento):
+        # Lê o trecho do disco num buffer próprio. O arquivo pode ter mudado depois da última
+        # varredura; uma leitura curta vira OSError, em vez do SIGBUS de um mmap truncado.
+        trecho = bytearray(comprimento)
+        with open(os.path.join(self.diretorio, nome), "rb") as f:
+            f.seek(inicio)
+            lidos = f.readinto(trecho)
+        if lidos != comprimento:
+            raise OSError(f"Arquivo '{nome}' mudou durante a leitura")
+        return trecho
+
+    def tamanho(self, nome):
+        info = self.arquivos.get(nome)
+        return None if info is None else info[0]
+
+class ManifestosArquivos:
+    # Digest SHA-256 de cada arquivo compartilhado e de cada um dos seus chunks, calculados em
+    # segundo plano e guardados em ARQUIVO_HASHES junto com o tamanho e o mtime usados no cálculo
+    def __init__(self, indice_arquivos, tamanho_chunk=TAMANHO_CHUNK):
+        self.indice_arquivos = indice_arquivos
+        self.tamanho_chunk = tamanho_chunk
+        self.caminho_cache = os.path.join(indice_arquivos.diretorio, ARQUIVO_HASHES)
+        self.manifestos = {}
+        self.lock = threading.Lock()
+        try:
+            with open(self.caminho_cache, "r") as f:
+                self.manifestos = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def obter(self, nome):
+        # Só devolve o manifesto se ele ainda corresponde ao arquivo indexado
+        info = self.indice_arquivos.arquivos.get(nome)
+        manifesto = self.manifestos.get(nome)
+        if info is None or manifesto is None:
+            return None
+        if (manifesto["tamanho"], manifesto["mtime"], manifesto["tamanho_chunk"]) != (info[0], info[1], self.tamanho_chunk):
+            return None
+        return manifesto
+
+    def calcular(self, nome, tamanho, mtime):
+        digest_total = hashlib.sha256()
+        digests_chunks = []
+        buffer = bytearray(self.tamanho_chunk)
+        with open(os.path.join(self.indice_arquivos.diretorio, nome), "rb") as f:
+            while True:
+                lidos = f.readinto(buffer)
+                if not lidos and digests_chunks:
+                    break
+                visao = memoryview(buffer)[:lidos]
+                digest_total.update(visao)
+                digests_chunks.append(hashlib.sha256(visao).hexdigest())
+                if lidos < self.tamanho_chunk:
+                    break
+        return {"tamanho": tamanho, "mtime": mtime, "tamanho_chunk": self.tamanho_chunk,
+                "total": digest_total.hexdigest(), "chunks": digests_chunks}
+
+    def calcular_pendentes(self):
+        # Calcula o que falta e descarta manifestos de arquivos que sumiram; devolve True se algo mudou
+        arquivos = dict(self.indice_arquivos.arquivos)
+        mudou = False
+        for nome in list(self.manifestos):
+            if nome not in arquivos:
+                with self.lock:
+                    del self.manifestos[nome]
+                mudou = True
+        for nome, (tamanho, mtime) in arquivos.items():
+            if self.obter(nome) is not None:
+                continue
+            try:
+                manifesto = self.calcular(nome, tamanho, mtime)
+            except OSError as e:
+                print(f"Erro ao calcular hash de {nome}: {e}")
+                continue
+            with self.lock:
+                self.manifestos[nome] = manifesto
+            mudou = True
+        if mudou:
+            self.salvar()
+        return mudou
+
+    def salvar(self):
+        temporario = self.caminho_cache + ".tmp"
+        with self.lock:
+            with open(temporario, "w") as f:
+                json.dump(self.manifestos, f)
+        os.replace(temporario, self.caminho_cache)
+
+    def monitorar(self, intervalo=INTERVALO_HASHES):
+        while True:
+            try:
+                self.calcular_pendentes()
+            except OSError as e:
+                print(f"Erro ao salvar hashes em '{self.caminho_cache}': {e}")
+            time.sleep(intervalo)
+
+class CacheChunks:
+    # LRU de chunks já codificados em base64, limitado pelo total de bytes guardados
+    def __init__(self, orcamento=ORCAMENTO_CACHE_CHUNKS):
+        self.orcamento = orcamento
+        self.usado = 0
+        self.itens = collections.OrderedDict()
+        self.acertos = 0
+        self.falhas = 0
+        self.lock = threading.Lock()
+
+    def obter(self, chave):
+        with self.lock:
+            valor = self.itens.get(chave)
+            if valor is None:
+                self.falhas += 1
+                return None
+            self.itens.move_to_end(chave)
+            self.acertos += 1
+            return valor
+
+    def guardar(self, chave, valor):
+        if len(valor) > self.orcamento:
+            return
+        with self.lock:
+            antigo = self.itens.pop(chave, None)
+            if antigo is not None:
+                self.usado -= len(antigo)
+            self.itens[chave] = valor
+            self.usado += len(valor)
+            while self.usado > self.orcamento:
+                _, removido = self.itens.popitem(last=False)
+                self.usado -= len(removido)
+
+    def estatisticas(self):
+        with self.lock:
+            return {"acertos": self.acertos, "falhas": self.falhas, "itens": len(self.itens), "bytes": self.usado}
+
 class Mensagem:
-    def __init__(self, origem, clock, tipo, argumentos=None):
+    # carga: os argumentos já unidos por espaço, quando quem cria a mensagem os tem prontos
+    def __init__(self, origem, clock, tipo, argumentos=None, carga=None):
         self.origem = origem
         self.clock = clock
         self.tipo = tipo
         self.argumentos = argumentos or []
+        self.carga = carga
 
     def construir_mensagem(self):
         mensagem = f"{self.origem} {self.clock} {self.tipo}"
-        if self.argumentos:
+        if self.carga is not None:
+            mensagem += " " + self.carga
+        elif self.argumentos:
             mensagem += " " + " ".join(self.argumentos)
         mensagem += "\n"
         return mensagem
 
+    def codificar(self, binario=False):
+        if not binario:
+            return self.construir_mensagem().encode()
+        origem = self.origem.encode()
+        codigo = CODIGOS_TIPO.get(self.tipo, 0)
+        partes = [b"", origem]
+        if codigo == 0:
+            tipo = self.tipo.encode()
+            partes.append(TAMANHO_ARGUMENTO.pack(len(tipo)) + tipo)
+        for argumento in self.argumentos:
+            dados = argumento.encode()
+            partes.append(TAMANHO_ARGUMENTO.pack(len(dados)))
+            partes.append(dados)
+        tamanho_corpo = sum(len(parte) for parte in partes)
+        partes[0] = CABECALHO_BINARIO.pack(MARCA_BINARIA, codigo, self.clock, len(origem), len(self.argumentos), tamanho_corpo)
+        return b"".join(partes)
+
+    @staticmethod
+    def analisar_binario(cabecalho, corpo):
+        # cabecalho: os CABECALHO_BINARIO.size bytes iniciais do quadro; corpo: o restante.
+        # Quadros malformados viram ValueError, como mensagens de texto inválidas.
+        try:
+            return Mensagem._analisar_binario(cabecalho, corpo)
+        except struct.error as e:
+            raise ValueError(f"Quadro binário truncado: {e}") from e
+
+    @staticmethod
+    def _analisar_binario(cabecalho, corpo):
+        _, codigo, clock, tamanho_origem, quantidade, _ = CABECALHO_BINARIO.unpack(cabecalho)
+        corpo = memoryview(corpo)
+        origem = str(corpo[:tamanho_origem], "utf-8")
+        posicao = tamanho_origem
+        if codigo == 0:
+            (tamanho,) = TAMANHO_ARGUMENTO.unpack_from(corpo, posicao)
+            posicao += TAMANHO_ARGUMENTO.size
+            tipo = str(corpo[posicao:posicao + tamanho], "utf-8")
+            posicao += tamanho
+        elif codigo < len(TIPOS_BINARIOS):
+            tipo = TIPOS_BINARIOS[codigo]
+        else:
+            raise ValueError(f"Tipo binário desconhecido: {codigo}")
+        argumentos = []
+        for _ in range(quantidade):
+            (tamanho,) = TAMANHO_ARGUMENTO.unpack_from(corpo, posicao)
+            posicao += TAMANHO_ARGUMENTO.size
+            argumentos.append(str(corpo[posicao:posicao + tamanho], "utf-8"))
+            posicao += tamanho
+        if posicao != len(corpo):
+            raise ValueError("Quadro binário com tamanho inconsistente")
+        return Mensagem(origem, clock, tipo, argumentos)
+
     @staticmethod
     def analisar_mensagem(mensagem_str):
         partes = mensagem_str.strip().split(" ")
@@ -73,212 +726,1435 @@ class Mensagem:
         argumentos = partes[3:]
         return Mensagem(origem, clock, tipo, argumentos)
 
-def enviar_hello(peer, endereco_porta, clock):
-    clock.incrementar()
-    mensagem = Mensagem(endereco_porta, clock.valor, "HELLO").construir_mensagem()
-    print(f"Encaminhando mensagem '{mensagem.strip()}' para {peer.endereco}:{peer.porta}")
+class LeitorSocket:
+    # Lê linhas e blocos de bytes de um socket, guardando o que sobrar de cada recv
+    def __init__(self, conexao):
+        self.conexao = conexao
+        self.buffer = bytearray()
+
+    def ler_linha(self):
+        inicio_busca = 0
+        while True:
+            fim = self.buffer.find(b"\n", inicio_busca)
+            if fim >= 0:
+                linha = bytes(self.buffer[:fim + 1])
+                del self.buffer[:fim + 1]
+                return linha.decode()
+            inicio_busca = len(self.buffer)
+            dados = self.conexao.recv(65536)
+            if not dados:
+                # Conexão encerrada: devolve o que tiver chegado
+                linha = bytes(self.buffer)
+                self.buffer.clear()
+                return linha.decode()
+            self.buffer += dados
+
+    def ler_para(self, destino):
+        # Preenche o buffer destino por inteiro, sem cópias intermediárias
+        visao = memoryview(destino)
+        recebidos = min(len(self.buffer), len(visao))
+        visao[:recebidos] = self.buffer[:recebidos]
+        del self.buffer[:recebidos]
+        while recebidos < len(visao):
+            n = self.conexao.recv_into(visao[recebidos:])
+            if n == 0:
+                raise ConnectionError("Conexão encerrada antes do fim do arquivo")
+            recebidos += n
+
+    def ler_exato(self, tamanho):
+        # Devolve exatamente tamanho bytes, ou None se a conexão encerrar antes
+        while len(self.buffer) < tamanho:
+            dados = self.conexao.recv(65536)
+            if not dados:
+                return None
+            self.buffer += dados
+        dados = bytes(self.buffer[:tamanho])
+        del self.buffer[:tamanho]
+        return dados
+
+    def ler_mensagem(self):
+        # Próxima mensagem completa da conexão, ou None quando o outro lado encerrar.
+        # Texto e quadros binários podem se alternar; o primeiro byte diz qual é qual.
+        while True:
+            if not self.buffer:
+                dados = self.conexao.recv(65536)
+                if not dados:
+                    return None
+                self.buffer += dados
+            if self.buffer[0] == MARCA_BINARIA:
+                cabecalho = self.ler_exato(CABECALHO_BINARIO.size)
+                corpo = None if cabecalho is None else self.ler_exato(CABECALHO_BINARIO.unpack(cabecalho)[-1])
+                if corpo is None:
+                    return None
+                return Mensagem.analisar_binario(cabecalho, corpo)
+            linha = self.ler_linha()
+            if not linha:
+                return None
+            if linha.strip():
+                return Mensagem.analisar_mensagem(linha)
+
+    def ler_resposta(self):
+        mensagem = self.ler_mensagem()
+        if mensagem is None:
+            raise ConnectionError("Conexão encerrada sem resposta")
+        return mensagem
+
+class PeerOcupado(ConnectionError):
+    # O peer recusou a conexão com BUSY porque a fila do servidor estava cheia
+    pass
+
+class LoteRecusado(ValueError):
+    # O peer anunciou BATCH mas respondeu outra coisa no lugar do BATCH_REPLY
+    pass
+
+def ler_lote(leitor, quantidade):
+    # Lê BATCH_REPLY <n> e as n respostas seguintes; ACK (mensagem sem resposta) vira None.
+    # BUSY é devolvido como veio, para o pool tentar de novo.
+    cabecalho = leitor.ler_resposta()
+    if cabecalho.tipo == "BUSY":
+        return cabecalho
+    if cabecalho.tipo != "BATCH_REPLY" or int(cabecalho.argumentos[0]) != quantidade:
+        raise LoteRecusado(cabecalho.tipo)
+    respostas = []
+    for _ in range(quantidade):
+        resposta = leitor.ler_resposta()
+        respostas.append(None if resposta.tipo == "ACK" else resposta)
+    return respostas
+
+class ConexaoPeer:
+    # Conexão TCP mantida aberta com um peer, reaproveitada entre mensagens
+    def __init__(self, endereco, porta):
+        self.endereco = endereco
+        self.porta = porta
+        self.socket = socket.create_connection((endereco, porta), timeout=TIMEOUT_CONEXAO)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.leitor = LeitorSocket(self.socket)
+        self.ultimo_uso = time.monotonic()
+        self.binario = False  # passa a True depois que o peer responde HELLO_BIN
+        self.avulsa = False  # fechada depois de uma troca, em vez de voltar ao pool
+
+    def enviar(self, mensagem):
+        self.socket.sendall(mensagem.codificar(self.binario))
+
+    def enviar_varias(self, mensagens):
+        # Uma única escrita para todas, sem esperar resposta entre elas
+        self.socket.sendall(b"".join(mensagem.codificar(self.binario) for mensagem in mensagens))
+
+    def negociar(self, endereco_porta, clock, formato):
+        # Manda HELLO <formato> (BIN ou TEXTO) em texto. Um peer atual responde HELLO_BIN (já em
+        # binário, e a conexão segue binária) ou HELLO_TEXTO, com as capacidades que atende;
+        # devolve essas capacidades, ou None se veio outra coisa. Um peer antigo lê o HELLO como
+        # sua única mensagem e não responde: quem chama decide quanto esperar.
+        valor = clock.incrementar()
+        self.enviar(Mensagem(endereco_porta, valor, "HELLO", [formato]))
+        resposta = self.leitor.ler_resposta()
+        clock.atualizar(resposta.clock)
+        if resposta.tipo not in ("HELLO_BIN", "HELLO_TEXTO"):
+            return None
+        self.binario = resposta.tipo == "HELLO_BIN"
+        return set(resposta.argumentos)
+
+    def ainda_aberta(self):
+        # Sem nada pendente para leitura a conexão segue válida; se houver algo,
+        # normalmente é o fim da conexão (o peer fechou por ociosidade)
+        try:
+            legiveis, _, _ = select.select([self.socket], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not legiveis
+
+    def fechar(self):
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+class PoolConexoes:
+    # Conexões ociosas por peer (endereco:porta), com descarte por tempo parado.
+    # Um peer antigo lê uma única mensagem por conexão e a deixa aberta sem ler mais nada, então
+    # só voltam ao pool conexões de peers que anunciaram KEEPALIVE na negociação (HELLO TEXTO,
+    # ou HELLO BIN com binario). Até lá cada troca usa uma conexão nova, fechada em seguida, e
+    # a negociação corre à parte, numa sondagem em segundo plano.
+    def __init__(self, endereco_porta, clock, tempo_ocioso=TEMPO_OCIOSO_POOL, binario=False):
+        self.tempo_ocioso = tempo_ocioso
+        self.binario = binario
+        self.endereco_porta = endereco_porta
+        self.clock = clock
+        self.anunciadas = {}  # capacidades anunciadas por peer na negociação
+        self.antigos = {}  # peers que não responderam à sondagem, até quando (monotônico) não sondar de novo
+        self.sondando = {}  # sondagens em andamento, com o evento de fim de cada uma
+        self.ociosas = {}
+        self.lock = threading.Lock()
+
+    def capacidades(self, endereco, porta):
+        # Vazio enquanto o peer não respondeu à sondagem
+        with self.lock:
+            return self.anunciadas.get(f"{endereco}:{porta}", set())
+
+    def antigo(self, endereco, porta):
+        with self.lock:
+            return self.antigos.get(f"{endereco}:{porta}", 0) > time.monotonic()
+
+    def _retirar(self, endereco, porta, sondar=True):
+        # Devolve (conexao, reaproveitada)
+        chave = f"{endereco}:{porta}"
+        sondagem = self._sondagem(endereco, porta) if sondar else None
+        if sondagem is not None and self.binario:
+            # Um peer atual responde logo e a troca já sai pela conexão negociada, em binário;
+            # um antigo fica calado e a troca segue em texto enquanto a sondagem espera
+            sondagem.wait(TIMEOUT_NEGOCIACAO)
+        agora = time.monotonic()
+        with self.lock:
+            livres = self.ociosas.get(chave, [])
+            while livres:
+                conexao = livres.pop()
+                if agora - conexao.ultimo_uso < self.tempo_ocioso and conexao.ainda_aberta():
+                    return conexao, True
+                conexao.fechar()
+            persistente = "KEEPALIVE" in self.anunciadas.get(chave, ())
+        # Aproveita a abertura de uma conexão nova para limpar as paradas de outros peers
+        self.descartar_ociosas()
+        conexao = ConexaoPeer(endereco, porta)
+        if not persistente:
+            conexao.avulsa = True
+        elif self.binario:
+            # Peer atual: a negociação de cada conexão nova é respondida
+            try:
+                conexao.negociar(self.endereco_porta, self.clock, "BIN")
+            except BaseException:
+                conexao.fechar()
+                raise
+        return conexao, False
+
+    def _sondagem(self, endereco, porta):
+        # Evento da sondagem em andamento com o peer, iniciando uma se preciso; None se o peer
+        # já anunciou KEEPALIVE ou foi sondado há pouco
+        chave = f"{endereco}:{porta}"
+        with self.lock:
+            if "KEEPALIVE" in self.anunciadas.get(chave, ()) or self.antigos.get(chave, 0) > time.monotonic():
+                return None
+            if chave not in self.sondando:
+                self.sondando[chave] = threading.Event()
+                threading.Thread(target=self._sondar, args=(endereco, porta), daemon=True).start()
+            return self.sondando[chave]
+
+    def _sondar(self, endereco, porta):
+        # Negocia numa conexão própria, com o prazo normal de resposta. Quem anuncia KEEPALIVE
+        # passa a ter as conexões reaproveitadas (a da sondagem já vai para o pool); quem fica
+        # calado ou fecha a conexão é tratado como antigo até INTERVALO_SONDAGEM depois.
+        chave = f"{endereco}:{porta}"
+        try:
+            conexao = ConexaoPeer(endereco, porta)
+        except OSError:
+            # Fora do ar: nada a concluir
+            with self.lock:
+                self.sondando.pop(chave).set()
+            return
+        try:
+            capacidades = conexao.negociar(self.endereco_porta, self.clock, "BIN" if self.binario else "TEXTO")
+        except (OSError, ValueError):
+            capacidades = None
+        persistente = capacidades is not None and "KEEPALIVE" in capacidades
+        if persistente:
+            self._devolver(conexao)
+        else:
+            conexao.fechar()
+        with self.lock:
+            if capacidades is not None:
+                self.anunciadas[chave] = capacidades
+            if not persistente:
+                self.antigos[chave] = time.monotonic() + INTERVALO_SONDAGEM
+            self.sondando.pop(chave).set()
+
+    def _devolver(self, conexao):
+        if conexao.avulsa:
+            conexao.fechar()
+            return
+        chave = f"{conexao.endereco}:{conexao.porta}"
+        conexao.ultimo_uso = time.monotonic()
+        with self.lock:
+            self.ociosas.setdefault(chave, []).append(conexao)
+
+    @contextlib.contextmanager
+    def conexao(self, endereco, porta):
+        # Empresta uma conexão; em caso de erro ela é descartada em vez de voltar ao pool
+        conexao, _ = self._retirar(endereco, porta)
+        try:
+            yield conexao
+        except BaseException:
+            conexao.fechar()
+            raise
+        self._devolver(conexao)
+
+    def enviar(self, endereco, porta, mensagem, aguardar_resposta=True, prazo=TIMEOUT_CONEXAO):
+        # Mensagem sem resposta não dispara a sondagem: um HELLO depois de um BYE
+        # faria o peer nos marcar ONLINE de novo
+        def ler(conexao):
+            if not aguardar_resposta:
+                return None
+            conexao.socket.settimeout(prazo)
+            try:
+                return conexao.leitor.ler_resposta()
+            finally:
+                conexao.socket.settimeout(TIMEOUT_CONEXAO)
+
+        return self._trocar(
+            endereco,
+            porta,
+            lambda conexao: conexao.enviar(mensagem),
+            ler,
+            sondar=aguardar_resposta
+        )
+
+    def enviar_lote(self, endereco, porta, mensagens):
+        # Manda BATCH <n> e as n mensagens numa única escrita e devolve as n respostas, na ordem.
+        # Só vai em lote para quem anunciou BATCH na negociação; os demais (antigos, ou ainda
+        # não sondados) recebem as mensagens uma a uma, então o lote só deve levar mensagens
+        # que sempre têm resposta.
+        if "BATCH" not in self.capacidades(endereco, porta):
+            return [self.enviar(endereco, porta, mensagem) for mensagem in mensagens]
+        envelope = Mensagem(mensagens[0].origem, mensagens[0].clock, "BATCH", [str(len(mensagens))])
+        return self._trocar(
+            endereco,
+            porta,
+            lambda conexao: conexao.enviar_varias([envelope] + mensagens),
+            lambda conexao: ler_lote(conexao.leitor, len(mensagens))
+        )
+
+    def _trocar(self, endereco, porta, enviar, ler, sondar=True):
+        # Se uma conexão reaproveitada falhar, tenta de novo uma única vez com uma conexão nova;
+        # se só demorou a responder, não: o peer já recebeu o pedido e pode estar atendendo.
+        # Respostas BUSY são repetidas algumas vezes com espera crescente antes de desistir.
+        espera = ESPERA_OCUPADO
+        tentativas_ocupado = 0
+        while True:
+            conexao, reaproveitada = self._retirar(endereco, porta, sondar)
+            try:
+                enviar(conexao)
+                resposta = ler(conexao)
+            except OSError as e:
+                conexao.fechar()
+                if reaproveitada and not isinstance(e, socket.timeout):
+                    continue
+                raise
+            except BaseException:
+                conexao.fechar()
+                raise
+            if isinstance(resposta, Mensagem) and resposta.tipo == "BUSY":
+                conexao.fechar()
+                tentativas_ocupado += 1
+                if tentativas_ocupado > TENTATIVAS_OCUPADO:
+                    raise PeerOcupado(f"Peer {endereco}:{porta} ocupado")
+                time.sleep(espera)
+                espera *= 2
+                continue
+            self._devolver(conexao)
+            return resposta
+
+    def descartar_ociosas(self):
+        agora = time.monotonic()
+        with self.lock:
+            for chave, livres in list(self.ociosas.items()):
+                for conexao in livres:
+                    if agora - conexao.ultimo_uso >= self.tempo_ocioso:
+                        conexao.fechar()
+                livres[:] = [c for c in livres if agora - c.ultimo_uso < self.tempo_ocioso]
+                if not livres:
+                    del self.ociosas[chave]
+
+    def fechar_todas(self):
+        with self.lock:
+            for livres in self.ociosas.values():
+                for conexao in livres:
+                    conexao.fechar()
+            self.ociosas.clear()
+
+def enviar_hello(peer, endereco_porta, clock, pool):
+    valor = clock.incrementar()
+    mensagem = Mensagem(endereco_porta, valor, "HELLO")
+    print(f"Encaminhando mensagem '{mensagem.construir_mensagem().strip()}' para {peer.endereco}:{peer.porta}")
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as cliente:
-            cliente.settimeout(5)
-            cliente.connect((peer.endereco, peer.porta))
-            cliente.sendall(mensagem.encode())
-            print("=> Mensagem enviada com sucesso!")
-            peer.atualizar_estado("ONLINE")
+        pool.enviar(peer.endereco, peer.porta, mensagem, aguardar_resposta=False)
+        print("=> Mensagem enviada com sucesso!")
+        peer.atualizar_estado(ONLINE)
     except (socket.timeout, ConnectionRefusedError, OSError) as e:
         print(f"Erro ao conectar com o peer {peer.endereco}:{peer.porta}: {e}")
-        peer.atualizar_estado("OFFLINE")
+        peer.atualizar_estado(OFFLINE)
 
-def obter_peers(lista_vizinhos, endereco_porta, clock):
-    for peer in lista_vizinhos:
-        clock.incrementar()
-        mensagem = Mensagem(endereco_porta, clock.valor, "GET_PEERS").construir_mensagem()
-        print(f"Encaminhando mensagem '{mensagem.strip()}' para {peer.endereco}:{peer.porta}")
+class DetectorFalhas:
+    # Heartbeat em segundo plano. A cada rodada manda GET_PEERS <versao> aos peers ONLINE que
+    # estão quietos há mais de um intervalo e espera a resposta (qualquer mensagem trocada com
+    # o peer atualiza ultimo_hello e conta como sinal de vida). Peer ONLINE sem notícia por
+    # FATOR_SUSPEITA intervalos é marcado OFFLINE, então busca e download param de gastar
+    # timeouts com ele.
+    def __init__(self, lista_vizinhos, endereco_porta, clock, pool, intervalo=INTERVALO_HEARTBEAT):
+        self.lista_vizinhos = lista_vizinhos
+        self.endereco_porta = endereco_porta
+        self.clock = clock
+        self.pool = pool
+        self.intervalo = intervalo
+        self.limite = FATOR_SUSPEITA * intervalo
+
+    def pingar(self, peer):
+        # Só a resposta conta: um peer travado ainda aceita o envio no buffer do kernel.
+        # GET_PEERS é respondido até por peers antigos.
+        try:
+            puxar_peers(peer, self.endereco_porta, self.clock, self.pool, self.lista_vizinhos)
+        except PeerOcupado:
+            # Recusou por estar ocupado, mas respondeu
+            peer.ultimo_hello = time.time()
+        except (OSError, ValueError):
+            pass
+
+    def rodada(self, executor):
+        agora = time.time()
+        quietos = []
+        for peer in self.lista_vizinhos:
+            if peer.estado != ONLINE:
+                continue
+            if agora - peer.ultimo_hello > self.limite:
+                print(f"Peer {peer.endereco}:{peer.porta} sem resposta há {int(agora - peer.ultimo_hello)}s")
+                peer.atualizar_estado(OFFLINE)
+            elif agora - peer.ultimo_hello > self.intervalo:
+                quietos.append(peer)
+        list(executor.map(self.pingar, quietos))
+
+    def monitorar(self):
+        with ThreadPoolExecutor(max_workers=MAX_CONSULTAS_PARALELAS) as executor:
+            while True:
+                time.sleep(self.intervalo)
+                self.rodada(executor)
+
+def pedir_peers(peer, endereco_porta, clock, pool, lista_vizinhos):
+    # Envia GET_PEERS <versao> a um vizinho e devolve as entradas recebidas. A versão é a última
+    # que ele nos mandou ("0" na primeira vez), então só voltam os peers alterados desde então.
+    # Um vizinho sem suporte a versões responde PEER_LIST com a tabela inteira.
+    mensagem = montar_get_peers(peer, endereco_porta, clock, lista_vizinhos)
+    return ler_peer_list(peer, pool.enviar(peer.endereco, peer.porta, mensagem), clock, lista_vizinhos)
+
+def puxar_peers(peer, endereco_porta, clock, pool, lista_vizinhos):
+    # GET_PEERS <versao> das trocas em segundo plano (heartbeat e anti-entropia), sem nada no
+    # terminal: a resposta é sinal de vida sem passar por atualizar_estado, e das alterações
+    # mescladas só aparecem os peers que mudaram de estado
+    conhecida = lista_vizinhos.versoes_vizinhos.get((peer.endereco, peer.porta), "0")
+    valor = clock.incrementar()
+    mensagem = Mensagem(endereco_porta, valor, "GET_PEERS", [conhecida])
+    resposta = pool.enviar(peer.endereco, peer.porta, mensagem)
+    clock.atualizar(resposta.clock)
+    peer.ultimo_hello = time.time()
+    peer.atualizar_relogio(resposta.clock)
+    processar_peer_list(entradas_peer_list(peer, resposta, lista_vizinhos), lista_vizinhos, silencioso=True)
+
+def montar_get_peers(peer, endereco_porta, clock, lista_vizinhos):
+    conhecida = lista_vizinhos.versoes_vizinhos.get((peer.endereco, peer.porta), "0")
+    valor = clock.incrementar()
+    mensagem = Mensagem(endereco_porta, valor, "GET_PEERS", [conhecida])
+    print(f"Encaminhando mensagem '{mensagem.construir_mensagem().strip()}' para {peer.endereco}:{peer.porta}")
+    return mensagem
+
+def ler_peer_list(peer, resposta_msg, clock, lista_vizinhos):
+    clock.atualizar(resposta_msg.clock)
+    peer.atualizar_estado(ONLINE)
+    peer.atualizar_relogio(resposta_msg.clock)
+    return entradas_peer_list(peer, resposta_msg, lista_vizinhos)
+
+def entradas_peer_list(peer, resposta_msg, lista_vizinhos):
+    if resposta_msg.tipo == "PEER_DELTA":
+        # PEER_DELTA <versao> <n> <end:porta:estado:relogio[:carimbo]>...
+        lista_vizinhos.versoes_vizinhos[(peer.endereco, peer.porta)] = resposta_msg.argumentos[0]
+        return resposta_msg.argumentos[2:]
+    if resposta_msg.tipo != "PEER_LIST":
+        return []
+    return resposta_msg.argumentos[1:]
+
+def entrada_peer(peer):
+    # end:porta:estado:relogio, com :carimbo no fim só quando há carimbo HLC
+    entrada = f"{peer.endereco}:{peer.porta}:{peer.estado}:{peer.relogio}"
+    carimbo = peer.carimbo
+    return f"{entrada}:{carimbo}" if carimbo else entrada
+
+def processar_peer_list(entradas, lista_vizinhos, silencioso=False):
+    # Mescla as entradas end:porta:estado:relogio[:carimbo] na lista local
+    for peer_info in entradas:
+        endereco, porta, estado, relogio, *carimbo = peer_info.split(":")
+        if estado not in ESTADOS:
+            continue
+        lista_vizinhos.mesclar(endereco, int(porta), estado, int(relogio), int(carimbo[0]) if carimbo else 0, silencioso)
+
+def obter_peers(lista_vizinhos, endereco_porta, clock, pool, prazo=PRAZO_DESCOBERTA):
+    # Consulta todos os vizinhos em paralelo e mescla cada PEER_LIST assim que chega;
+    # quem não responder dentro do prazo da rodada é deixado para trás
+    vizinhos = list(lista_vizinhos)
+    if not vizinhos:
+        return
+    executor = ThreadPoolExecutor(max_workers=min(MAX_CONSULTAS_PARALELAS, len(vizinhos)))
+    futuros = {executor.submit(pedir_peers, peer, endereco_porta, clock, pool, lista_vizinhos): peer for peer in vizinhos}
+    try:
+        for futuro in as_completed(futuros, timeout=prazo):
+            peer = futuros[futuro]
+            try:
+                entradas = futuro.result()
+            except PeerOcupado as e:
+                print(e)
+                continue
+            except (OSError, ValueError) as e:
+                print(f"Falha ao contatar {peer.endereco}:{peer.porta}: {e}")
+                peer.atualizar_estado(OFFLINE)
+                continue
+            processar_peer_list(entradas, lista_vizinhos)
+    except PrazoEsgotado:
+        for futuro, peer in futuros.items():
+            if not futuro.done():
+                print(f"Peer {peer.endereco}:{peer.porta} não respondeu dentro de {prazo}s")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+class AntiEntropia:
+    # Troca periódica (push-pull) com um vizinho ONLINE sorteado: puxa as alterações dele com
+    # GET_PEERS <versao> e empurra as nossas com PEER_PUSH, só o que mudou desde a última troca
+    # com aquele vizinho. O tráfego de membros cresce com as mudanças, não com o tamanho da rede.
+    def __init__(self, lista_vizinhos, endereco_porta, clock, pool, intervalo=INTERVALO_ANTI_ENTROPIA):
+        self.lista_vizinhos = lista_vizinhos
+        self.endereco_porta = endereco_porta
+        self.clock = clock
+        self.pool = pool
+        self.intervalo = intervalo
+        self.enviadas = {}  # (endereco, porta) -> nossa versão já empurrada para aquele vizinho
+
+    def empurrar(self, peer):
+        chave = (peer.endereco, peer.porta)
+        atual, alterados = self.lista_vizinhos.alteracoes_desde(self.enviadas.get(chave, "0"))
+        if alterados:
+            valor = self.clock.incrementar()
+            mensagem = Mensagem(
+                self.endereco_porta,
+                valor,
+                "PEER_PUSH",
+                [str(len(alterados))] + [entrada_peer(p) for p in alterados]
+            )
+            self.pool.enviar(peer.endereco, peer.porta, mensagem, aguardar_resposta=False)
+        self.enviadas[chave] = atual
+
+    def rodada(self):
+        online = [peer for peer in self.lista_vizinhos if peer.estado == ONLINE]
+        if not online:
+            return
+        peer = random.choice(online)
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as cliente:
-                cliente.settimeout(5)
-                cliente.connect((peer.endereco, peer.porta))
-                cliente.sendall(mensagem.encode())
-                resposta = cliente.recv(8192).decode()
-                resposta_msg = Mensagem.analisar_mensagem(resposta)
-                clock.atualizar(resposta_msg.clock)
-                peer.atualizar_estado("ONLINE")
-                peer.atualizar_relogio(resposta_msg.clock)
-                if resposta_msg.tipo == "PEER_LIST":
-                    for peer_info in resposta_msg.argumentos[1:]:
-                        endereco, porta, estado, relogio = peer_info.split(":")
-                        porta = int(porta)
-                        relogio = int(relogio)
-                        existente = next((p for p in lista_vizinhos if p.endereco == endereco and p.porta == porta), None)
-                        if existente:
-                            if relogio > existente.relogio:
-                                existente.atualizar_estado(estado)
-                                existente.atualizar_relogio(relogio)
-                        else:
-                            novo = Peer(endereco, porta)
-                            novo.atualizar_estado(estado)
-                            novo.atualizar_relogio(relogio)
-                            lista_vizinhos.append(novo)
-        except (socket.timeout, ConnectionRefusedError, OSError) as e:
+            puxar_peers(peer, self.endereco_porta, self.clock, self.pool, self.lista_vizinhos)
+            self.empurrar(peer)
+        except PeerOcupado as e:
+            print(e)
+        except (OSError, ValueError) as e:
             print(f"Falha ao contatar {peer.endereco}:{peer.porta}: {e}")
-            peer.atualizar_estado("OFFLINE")
+            peer.atualizar_estado(OFFLINE)
+
+    def monitorar(self):
+        while True:
+            time.sleep(self.intervalo)
+            self.rodada()
 
-def listar_arquivos(diretorio_compartilhado):
+def listar_arquivos(indice_arquivos):
     # Lista os arquivos do diretório compartilhado local
     try:
-        arquivos = os.listdir(diretorio_compartilhado)
-        print("\nArquivos compartilhados:")
-        for arquivo in arquivos:
-            print(arquivo)
+        indice_arquivos.atualizar()
     except FileNotFoundError:
-        print(f"Erro: Diretório '{diretorio_compartilhado}' não encontrado.")
+        print(f"Erro: Diretório '{indice_arquivos.diretorio}' não encontrado.")
+        return
+    print("\nArquivos compartilhados:")
+    for arquivo in indice_arquivos.nomes():
+        print(arquivo)
 
 
-def sair(lista_vizinhos, endereco_porta, clock, servidor):
-    # Envia BYE para todos os peers e encerra o programa
-    print("Encerrando peer...")
+def sair(lista_vizinhos, endereco_porta, clock, servidor, pool):
+    # Envia BYE para os peers ONLINE e encerra o programa
     for peer in lista_vizinhos:
-        clock.incrementar()
-        mensagem = Mensagem(endereco_porta, clock.valor, "BYE").construir_mensagem()
-        print(f'Encaminhando mensagem "{mensagem}" para {peer.endereco}:{peer.porta}')
+        if peer.estado != ONLINE:
+            continue
+        valor = clock.incrementar()
+        mensagem = Mensagem(endereco_porta, valor, "BYE")
+        print(f"Encaminhando mensagem \"{mensagem.construir_mensagem().strip()}\" para {peer.endereco}:{peer.porta}")
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as cliente:
-                cliente.settimeout(5)
-                cliente.connect((peer.endereco, peer.porta))
-                cliente.sendall(mensagem.encode())
-        except (socket.timeout, ConnectionRefusedError):
+            pool.enviar(peer.endereco, peer.porta, mensagem, aguardar_resposta=False)
+        except OSError:
             print(f"Falha ao notificar {peer.endereco}:{peer.porta}")
-    
+
+    pool.fechar_todas()
     servidor.close()
-    print("Peer encerrado com sucesso.")
+    print("Encerrando peer.")
     sys.exit(0)
 
-def buscar_arquivos(lista_vizinhos, endereco_porta, clock):
-    arquivos_encontrados = []
-    for peer in lista_vizinhos:
-        if peer.estado != "ONLINE":
-            continue
-        clock.incrementar()
-        mensagem = Mensagem(endereco_porta, clock.valor, "LS").construir_mensagem()
-        print(f"Encaminhando mensagem \"{mensagem.strip()}\" para {peer.endereco}:{peer.porta}")
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as cliente:
-                cliente.settimeout(5)
-                cliente.connect((peer.endereco, peer.porta))
-                cliente.sendall(mensagem.encode())
-                resposta = cliente.recv(8192).decode()
-                resposta_mensagem = Mensagem.analisar_mensagem(resposta)
-                clock.atualizar(resposta_mensagem.clock)
-                peer.atualizar_estado("ONLINE")
-                quantidade = int(resposta_mensagem.argumentos[0])
-                for info in resposta_mensagem.argumentos[1:]:
-                    nome, tamanho = info.split(":")
-                    arquivos_encontrados.append((nome, tamanho, f"{peer.endereco}:{peer.porta}"))
-        except Exception as e:
-            print(f"Erro ao conectar com {peer.endereco}:{peer.porta}: {e}")
-            peer.atualizar_estado("OFFLINE")
+class CacheBusca:
+    # Último LS_LIST recebido de cada peer. Dentro do TTL é usado sem ir à rede; depois disso
+    # o peer é consultado com a versão guardada e pode responder só LS_NOT_MODIFIED.
+    # Qualquer mudança de estado do peer (OFFLINE, BYE, volta a ONLINE) descarta a entrada.
+    def __init__(self, lista_vizinhos, ttl=TTL_BUSCA):
+        self.ttl = ttl
+        self.entradas = {}
+        self.lock = threading.Lock()
+        lista_vizinhos.observar(lambda peer, anterior, novo: self.invalidar(peer))
+
+    def obter(self, peer):
+        # Devolve (versao, arquivos, ainda_no_ttl) ou None
+        with self.lock:
+            entrada = self.entradas.get((peer.endereco, peer.porta))
+        if entrada is None:
+            return None
+        versao, arquivos, instante = entrada
+        return versao, arquivos, time.monotonic() - instante < self.ttl
+
+    def guardar(self, peer, versao, arquivos):
+        with self.lock:
+            self.entradas[(peer.endereco, peer.porta)] = (versao, arquivos, time.monotonic())
+
+    def invalidar(self, peer):
+        with self.lock:
+            self.entradas.pop((peer.endereco, peer.porta), None)
+
+def pedir_peers_e_arquivos(peer, endereco_porta, clock, pool, lista_vizinhos, cache_busca):
+    # Devolve a lista de (nome, tamanho) anunciada pelo peer. Com o LS dele ainda no TTL do
+    # cache não há ida à rede; senão GET_PEERS e LS vão numa única ida e volta (BATCH),
+    # e a busca também atualiza a lista de peers.
+    guardado = cache_busca.obter(peer)
+    if guardado is not None and guardado[2]:
+        return guardado[1]
+    mensagens = [montar_get_peers(peer, endereco_porta, clock, lista_vizinhos), montar_ls(peer, endereco_porta, clock, guardado)]
+    respostas = pool.enviar_lote(peer.endereco, peer.porta, mensagens)
+    if None in respostas:
+        raise ValueError("Resposta faltando no lote")
+    processar_peer_list(ler_peer_list(peer, respostas[0], clock, lista_vizinhos), lista_vizinhos)
+    return ler_ls(peer, respostas[1], clock, cache_busca, guardado)
+
+def montar_ls(peer, endereco_porta, clock, guardado):
+    # LS com a versão guardada ("-" sem cache) para o peer poder responder LS_NOT_MODIFIED
+    versao_conhecida = guardado[0] if guardado is not None and guardado[0] else "-"
+    valor = clock.incrementar()
+    mensagem = Mensagem(endereco_porta, valor, "LS", [versao_conhecida])
+    print(f"Encaminhando mensagem \"{mensagem.construir_mensagem().strip()}\" para {peer.endereco}:{peer.porta}")
+    return mensagem
 
+def ler_ls(peer, resposta_mensagem, clock, cache_busca, guardado):
+    clock.atualizar(resposta_mensagem.clock)
+    peer.atualizar_estado(ONLINE)
+    if resposta_mensagem.tipo == "LS_NOT_MODIFIED" and guardado is not None:
+        arquivos = guardado[1]
+        versao = resposta_mensagem.argumentos[0]
+    elif resposta_mensagem.tipo == "LS_LIST_V":
+        versao = resposta_mensagem.argumentos[0]
+        arquivos = [tuple(info.rsplit(":", 1)) for info in resposta_mensagem.argumentos[2:]]
+    else:
+        # Peer antigo, sem versão: o cache vale só pelo TTL
+        versao = None
+        arquivos = [tuple(info.rsplit(":", 1)) for info in resposta_mensagem.argumentos[1:]]
+    cache_busca.guardar(peer, versao, arquivos)
+    return arquivos
+
+def buscar_arquivos(lista_vizinhos, endereco_porta, clock, indice_arquivos, pool, cache_busca, prazo=PRAZO_BUSCA):
+    # Pergunta a todos os peers ONLINE em paralelo e mostra as linhas da tabela
+    # conforme cada LS_LIST chega; quem passar do prazo fica de fora.
+    # Cada peer recebe GET_PEERS e LS no mesmo lote, então a busca também atualiza os peers;
+    # peers com o LS ainda no TTL do cache nem são consultados.
+    arquivos_encontrados = []
+    online = [peer for peer in lista_vizinhos if peer.estado == ONLINE]
     print("\nArquivos encontrados na rede:")
     print("Nome | Tamanho | Peer")
     print("[ 0] <Cancelar> | |")
-    for i, (nome, tamanho, peer_end) in enumerate(arquivos_encontrados, 1):
-        print(f"[{i}] {nome} | {tamanho} | {peer_end}")
+    if online:
+        executor = ThreadPoolExecutor(max_workers=min(MAX_CONSULTAS_PARALELAS, len(online)))
+        futuros = {executor.submit(pedir_peers_e_arquivos, peer, endereco_porta, clock, pool, lista_vizinhos, cache_busca): peer for peer in online}
+        try:
+            for futuro in as_completed(futuros, timeout=prazo):
+                peer = futuros[futuro]
+                try:
+                    arquivos = futuro.result()
+                except PeerOcupado as e:
+                    print(e)
+                    continue
+                except Exception as e:
+                    print(f"Erro ao conectar com {peer.endereco}:{peer.porta}: {e}")
+                    peer.atualizar_estado(OFFLINE)
+                    continue
+                for nome, tamanho in arquivos:
+                    arquivos_encontrados.append((nome, tamanho, peer))
+                    print(f"[{len(arquivos_encontrados)}] {nome} | {tamanho} | {peer.endereco}:{peer.porta}")
+        except PrazoEsgotado:
+            for futuro, peer in futuros.items():
+                if not futuro.done():
+                    print(f"Peer {peer.endereco}:{peer.porta} não respondeu dentro de {prazo}s")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
+    escolher_download(arquivos_encontrados, clock, endereco_porta, indice_arquivos, pool)
+
+def escolher_download(arquivos_encontrados, clock, endereco_porta, indice_arquivos, pool):
+    # arquivos_encontrados: lista de (nome, tamanho, peer) já mostrada numerada ao usuário
     escolha = input("\nDigite o numero do arquivo para fazer o download:\n> ")
     if escolha.isdigit():
         escolha = int(escolha)
         if escolha == 0 or escolha > len(arquivos_encontrados):
             return
-        nome, tamanho, peer_end = arquivos_encontrados[escolha - 1]
-        endereco, porta = peer_end.split(":")
-        realizar_download(endereco, int(porta), nome, clock, endereco_porta)
-
-def realizar_download(endereco, porta, nome_arquivo, clock, endereco_porta):
-    clock.incrementar()
-    mensagem = Mensagem(endereco_porta, clock.valor, "DL", [nome_arquivo, "0", "0"]).construir_mensagem()
-    print(f"=> Atualizando relogio para {clock.valor}")
-    print(f"Encaminhando mensagem \"{mensagem.strip()}\" para {endereco}:{porta}")
+        nome, tamanho, _ = arquivos_encontrados[escolha - 1]
+        # Todos os peers que anunciam o mesmo nome e tamanho servem de fonte para o download
+        fontes = [p for (n, t, p) in arquivos_encontrados if n == nome and t == tamanho]
+        realizar_download(fontes, nome, int(tamanho), clock, endereco_porta, indice_arquivos.diretorio, pool)
+        indice_arquivos.atualizar()
+
+class IndiceResultados:
+    # Índice invertido do lado do cliente com tudo o que os peers devolveram em SEARCH:
+    # palavra -> (nome, tamanho) e (nome, tamanho) -> peers que anunciam o arquivo.
+    # Entradas de um peer saem quando o estado dele muda e são trocadas a cada nova resposta dele.
+    def __init__(self, lista_vizinhos):
+        self.palavras = {}
+        self.fontes = {}
+        self.lock = threading.Lock()
+        lista_vizinhos.observar(lambda peer, anterior, novo: self.remover_peer(peer))
+
+    def _remover(self, arquivo, peer):
+        fontes = self.fontes.get(arquivo)
+        if fontes is None:
+            return
+        fontes.pop((peer.endereco, peer.porta), None)
+        if not fontes:
+            del self.fontes[arquivo]
+            for palavra in palavras_nome(arquivo[0]):
+                arquivos = self.palavras.get(palavra)
+                if arquivos is not None:
+                    arquivos.discard(arquivo)
+                    if not arquivos:
+                        del self.palavras[palavra]
+
+    def substituir(self, peer, palavras, arquivos):
+        # A resposta do peer para estas palavras substitui o que ele tinha anunciado antes para elas
+        with self.lock:
+            for arquivo in self._buscar(palavras):
+                self._remover(arquivo, peer)
+            for nome, tamanho in arquivos:
+                arquivo = (nome, str(tamanho))
+                self.fontes.setdefault(arquivo, {})[(peer.endereco, peer.porta)] = peer
+                for palavra in palavras_nome(nome):
+                    self.palavras.setdefault(palavra, set()).add(arquivo)
+
+    def remover_peer(self, peer):
+        with self.lock:
+            for arquivo in list(self.fontes):
+                self._remover(arquivo, peer)
+
+    def _buscar(self, palavras):
+        arquivos = None
+        for palavra in palavras:
+            encontrados = self.palavras.get(palavra, set())
+            arquivos = set(encontrados) if arquivos is None else arquivos & encontrados
+        return sorted(arquivos or ())
+
+    def buscar(self, palavras):
+        # Devolve [(nome, tamanho, [peers])]
+        with self.lock:
+            return [(nome, tamanho, list(self.fontes[(nome, tamanho)].values())) for nome, tamanho in self._buscar(palavras)]
+
+def pedir_busca(peer, palavras, endereco_porta, clock, pool):
+    # Envia SEARCH a um peer e devolve só os (nome, tamanho) que casam com as palavras
+    valor = clock.incrementar()
+    mensagem = Mensagem(endereco_porta, valor, "SEARCH", palavras)
+    print(f"Encaminhando mensagem \"{mensagem.construir_mensagem().strip()}\" para {peer.endereco}:{peer.porta}")
+    resposta_mensagem = pool.enviar(peer.endereco, peer.porta, mensagem)
+    clock.atualizar(resposta_mensagem.clock)
+    peer.atualizar_estado(ONLINE)
+    if resposta_mensagem.tipo != "SEARCH_LIST":
+        return []
+    return [tuple(info.rsplit(":", 1)) for info in resposta_mensagem.argumentos[1:]]
+
+def buscar_palavras(lista_vizinhos, endereco_porta, clock, indice_arquivos, pool, indice_resultados, prazo=PRAZO_BUSCA):
+    # Pergunta a todos os peers ONLINE em paralelo só pelos arquivos com as palavras digitadas;
+    # as respostas vão para o índice agregado, que mostra cada arquivo uma vez com todas as fontes
+    palavras = palavras_nome(input("Digite as palavras-chave: "))
+    if not palavras:
+        print("Nenhuma palavra-chave informada.")
+        return
+    online = [peer for peer in lista_vizinhos if peer.estado == ONLINE]
+    if online:
+        executor = ThreadPoolExecutor(max_workers=min(MAX_CONSULTAS_PARALELAS, len(online)))
+        futuros = {executor.submit(pedir_busca, peer, palavras, endereco_porta, clock, pool): peer for peer in online}
+        try:
+            for futuro in as_completed(futuros, timeout=prazo):
+                peer = futuros[futuro]
+                try:
+                    indice_resultados.substituir(peer, palavras, futuro.result())
+                except PeerOcupado as e:
+                    print(e)
+                except Exception as e:
+                    print(f"Erro ao conectar com {peer.endereco}:{peer.porta}: {e}")
+                    peer.atualizar_estado(OFFLINE)
+        except PrazoEsgotado:
+            for futuro, peer in futuros.items():
+                if not futuro.done():
+                    print(f"Peer {peer.endereco}:{peer.porta} não respondeu dentro de {prazo}s")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    arquivos_encontrados = []
+    print("\nArquivos encontrados na rede:")
+    print("Nome | Tamanho | Peers")
+    print("[ 0] <Cancelar> | |")
+    for i, (nome, tamanho, fontes) in enumerate(indice_resultados.buscar(palavras), 1):
+        print(f"[{i}] {nome} | {tamanho} | " + ", ".join(f"{p.endereco}:{p.porta}" for p in fontes))
+        arquivos_encontrados.append((nome, tamanho, fontes))
+    escolha = input("\nDigite o numero do arquivo para fazer o download:\n> ")
+    if escolha.isdigit() and 0 < int(escolha) <= len(arquivos_encontrados):
+        nome, tamanho, fontes = arquivos_encontrados[int(escolha) - 1]
+        realizar_download(fontes, nome, int(tamanho), clock, endereco_porta, indice_arquivos.diretorio, pool)
+        indice_arquivos.atualizar()
+
+class BuscaInundacao:
+    # Busca que passa dos vizinhos diretos: QUERY <id> <ttl> <origem> <termo> é repassado
+    # de vizinho em vizinho até o ttl acabar, e cada peer com arquivos que casam com o termo
+    # responde QUERY_HIT <id> <n> <nome:tamanho>... direto para quem iniciou a busca.
+    # O termo é casado pelas palavras do nome, usando o índice invertido de IndiceArquivos.
+    # Ids já vistos ficam num conjunto limitado para que cópias do mesmo QUERY sejam ignoradas.
+    def __init__(self, endereco_porta, clock, lista_vizinhos, indice_arquivos, pool):
+        self.endereco_porta = endereco_porta
+        self.clock = clock
+        self.lista_vizinhos = lista_vizinhos
+        self.indice_arquivos = indice_arquivos
+        self.pool = pool
+        self.vistas = collections.OrderedDict()
+        self.pendentes = {}  # id -> fila dos QUERY_HIT de buscas iniciadas aqui
+        self.contador = 0
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=MAX_CONSULTAS_PARALELAS)
+
+    def marcar_vista(self, id_consulta):
+        # Devolve False se o id já tinha passado por aqui
+        with self.lock:
+            if id_consulta in self.vistas:
+                self.vistas.move_to_end(id_consulta)
+                return False
+            self.vistas[id_consulta] = None
+            if len(self.vistas) > MAX_CONSULTAS_VISTAS:
+                self.vistas.popitem(last=False)
+            return True
+
+    def enviar(self, endereco, porta, tipo, argumentos):
+        valor = self.clock.incrementar()
+        mensagem = Mensagem(self.endereco_porta, valor, tipo, argumentos)
+        print(f"Encaminhando mensagem \"{mensagem.construir_mensagem().strip()}\" para {endereco}:{porta}")
+        try:
+            self.pool.enviar(endereco, porta, mensagem, aguardar_resposta=False)
+        except OSError as e:
+            print(f"Erro ao conectar com {endereco}:{porta}: {e}")
+            return False
+        return True
+
+    def repassar(self, id_consulta, ttl, origem, termo, exceto=()):
+        for peer in self.lista_vizinhos:
+            if peer.estado != ONLINE or f"{peer.endereco}:{peer.porta}" in exceto:
+                continue
+            self.executor.submit(self._repassar_para, peer, [id_consulta, str(ttl), origem, termo])
+
+    def _repassar_para(self, peer, argumentos):
+        if not self.enviar(peer.endereco, peer.porta, "QUERY", argumentos):
+            peer.atualizar_estado(OFFLINE)
+
+    def buscar(self, termo, ttl=TTL_INUNDACAO):
+        # Dispara a busca e devolve a fila onde chegam (peer, [(nome, tamanho)]) de cada QUERY_HIT
+        with self.lock:
+            self.contador += 1
+            id_consulta = f"{self.endereco_porta}-{int(time.time())}-{self.contador}"
+            self.pendentes[id_consulta] = queue.Queue()
+        self.marcar_vista(id_consulta)
+        self.repassar(id_consulta, ttl, self.endereco_porta, termo)
+        return id_consulta, self.pendentes[id_consulta]
+
+    def encerrar(self, id_consulta):
+        with self.lock:
+            self.pendentes.pop(id_consulta, None)
+
+    def receber_consulta(self, remetente, argumentos):
+        # Chamado pelo servidor ao receber QUERY
+        id_consulta, ttl, origem, termo = argumentos[0], int(argumentos[1]), argumentos[2], argumentos[3]
+        if not self.marcar_vista(id_consulta):
+            return
+        encontrados = [f"{nome}:{tamanho}" for nome, tamanho in self.indice_arquivos.buscar(palavras_nome(termo))]
+        if encontrados:
+            endereco, porta = origem.rsplit(":", 1)
+            self.executor.submit(self.enviar, endereco, int(porta), "QUERY_HIT", [id_consulta, str(len(encontrados))] + encontrados)
+        if ttl > 1:
+            self.repassar(id_consulta, ttl - 1, origem, termo, exceto=(remetente, origem))
+
+    def receber_resultado(self, peer, argumentos):
+        # Chamado pelo servidor ao receber QUERY_HIT; respostas de buscas já encerradas são descartadas
+        with self.lock:
+            fila = self.pendentes.get(argumentos[0])
+        if fila is not None:
+            fila.put((peer, [tuple(info.rsplit(":", 1)) for info in argumentos[2:]]))
+
+def buscar_por_inundacao(inundacao, clock, endereco_porta, indice_arquivos, pool, prazo=PRAZO_INUNDACAO):
+    termo = input("Digite o termo de busca: ").strip()
+    if not termo or " " in termo:
+        print("Termo inválido.")
+        return
+    ttl = input(f"Alcance em saltos [{TTL_INUNDACAO}]: ").strip()
+    ttl = int(ttl) if ttl.isdigit() and int(ttl) > 0 else TTL_INUNDACAO
+    id_consulta, fila = inundacao.buscar(termo, ttl)
+    arquivos_encontrados = []
+    print("\nArquivos encontrados na rede:")
+    print("Nome | Tamanho | Peer")
+    print("[ 0] <Cancelar> | |")
+    limite = time.monotonic() + prazo
+    try:
+        while True:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                peer, arquivos = fila.get(timeout=restante)
+            except queue.Empty:
+                break
+            for nome, tamanho in arquivos:
+                arquivos_encontrados.append((nome, tamanho, peer))
+                print(f"[{len(arquivos_encontrados)}] {nome} | {tamanho} | {peer.endereco}:{peer.porta}")
+    finally:
+        inundacao.encerrar(id_consulta)
+    escolher_download(arquivos_encontrados, clock, endereco_porta, indice_arquivos, pool)
+
+def baixar_chunk(endereco, porta, nome_arquivo, indice, tamanho, clock, endereco_porta, pool):
+    # Devolve [(indice, conteudo)] com o chunk pedido. O argumento RAW pede o chunk em bytes
+    # crus logo após a linha FILE_RAW; peers que não conhecem o modo respondem com o FILE em
+    # base64 de sempre. Peers antigos ignoram também o chunk pedido e mandam o arquivo inteiro
+    # (FILE <nome> 0 0): nesse caso voltam todos os chunks, recortados do arquivo recebido.
+    esperado = min(TAMANHO_CHUNK, tamanho - indice * TAMANHO_CHUNK)
+    valor = clock.incrementar()
+    mensagem = Mensagem(endereco_porta, valor, "DL", [nome_arquivo, str(TAMANHO_CHUNK), str(indice), "RAW"])
+    print(f"Encaminhando mensagem \"{mensagem.construir_mensagem().strip()}\" para {endereco}:{porta}")
+    with pool.conexao(endereco, porta) as conexao:
+        conexao.enviar(mensagem)
+        mensagem_resposta = conexao.leitor.ler_resposta()
+        if mensagem_resposta.tipo == "BUSY":
+            raise PeerOcupado(f"Peer {endereco}:{porta} ocupado")
+        clock.atualizar(mensagem_resposta.clock)
+        if mensagem_resposta.tipo == "FILE_RAW":
+            if mensagem_resposta.argumentos[1:4] != [str(TAMANHO_CHUNK), str(indice), str(esperado)]:
+                raise ValueError(f"FILE_RAW não corresponde ao chunk {indice}: {' '.join(mensagem_resposta.argumentos[1:4])}")
+            conteudo = bytearray(esperado)
+            conexao.leitor.ler_para(conteudo)
+            return [(indice, conteudo)]
+    if mensagem_resposta.tipo != "FILE":
+        raise ValueError(f"Resposta inesperada ao DL: {mensagem_resposta.tipo}")
+    argumentos = mensagem_resposta.argumentos
+    # Um arquivo vazio chega sem o último argumento
+    conteudo = base64.b64decode(argumentos[3]) if len(argumentos) > 3 else b""
+    if argumentos[1:3] == [str(TAMANHO_CHUNK), str(indice)] and len(conteudo) == esperado:
+        return [(indice, conteudo)]
+    if argumentos[1:3] == ["0", "0"] and len(conteudo) == tamanho:
+        total_chunks = max(1, -(-tamanho // TAMANHO_CHUNK))
+        return [(i, conteudo[i * TAMANHO_CHUNK:(i + 1) * TAMANHO_CHUNK]) for i in range(total_chunks)]
+    raise ValueError(f"FILE com {len(conteudo)} bytes não corresponde ao chunk {indice} pedido")
+
+def pedir_manifesto(peer, nome_arquivo, clock, endereco_porta, pool):
+    # Devolve a lista de digests por chunk do arquivo no peer, ou None se ele não tiver manifesto.
+    # Peers antigos não conhecem HASH e nunca respondem, então quem ainda não anunciou o que
+    # atende na negociação tem só o prazo curto.
+    valor = clock.incrementar()
+    mensagem = Mensagem(endereco_porta, valor, "HASH", [nome_arquivo])
+    print(f"Encaminhando mensagem \"{mensagem.construir_mensagem().strip()}\" para {peer.endereco}:{peer.porta}")
+    prazo = TIMEOUT_CONEXAO if pool.capacidades(peer.endereco, peer.porta) else TIMEOUT_NEGOCIACAO
+    resposta = pool.enviar(peer.endereco, peer.porta, mensagem, prazo=prazo)
+    clock.atualizar(resposta.clock)
+    if resposta.tipo != "HASH_LIST" or int(resposta.argumentos[1]) != TAMANHO_CHUNK:
+        return None
+    return resposta.argumentos[4:]
+
+def obter_manifesto(fontes, nome_arquivo, clock, endereco_porta, pool):
+    # Pergunta a todas as fontes ao mesmo tempo e usa o primeiro manifesto que chegar.
+    # Fontes que a sondagem do pool já apontou como antigas ficam de fora.
+    fontes = [fonte for fonte in fontes if not pool.antigo(fonte.endereco, fonte.porta)]
+    if not fontes:
+        return None
+    executor = ThreadPoolExecutor(max_workers=min(len(fontes), MAX_CONSULTAS_PARALELAS))
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as cliente:
-            cliente.settimeout(5)
-            cliente.connect((endereco, porta))
-            cliente.sendall(mensagem.encode())
-            resposta = cliente.recv(10 * 1024 * 1024).decode()
-            mensagem_resposta = Mensagem.analisar_mensagem(resposta)
-            clock.atualizar(mensagem_resposta.clock)
-            nome, _, _, conteudo_base64 = mensagem_resposta.argumentos
-            with open(os.path.join("compartilhado", nome), "wb") as f:
-                f.write(base64.b64decode(conteudo_base64))
-            print(f"Download do arquivo {nome} finalizado.")
+        pedidos = [
+            executor.submit(pedir_manifesto, fonte, nome_arquivo, clock, endereco_porta, pool)
+            for fonte in fontes
+        ]
+        for pedido in as_completed(pedidos):
+            try:
+                digests = pedido.result()
+            except (OSError, ValueError, IndexError):
+                continue
+            if digests is not None:
+                return digests
+    finally:
+        # Não espera as fontes que ainda não responderam
+        executor.shutdown(wait=False, cancel_futures=True)
+    return None
+
+def ler_diario(caminho_diario, tamanho):
+    # Índices já gravados segundo o diário, ou None se ele não existir ou for de outro download
+    try:
+        with open(caminho_diario, "r") as f:
+            cabecalho = f.readline().split()
+            if cabecalho != [str(tamanho), str(TAMANHO_CHUNK)]:
+                return None
+            # A última linha pode ter ficado pela metade se o processo caiu no meio da escrita
+            return {int(linha) for linha in f if linha.strip().isdigit()}
+    except OSError:
+        return None
+
+def chunks_validos(caminho_parcial, concluidos, tamanho, digests):
+    # Confere no disco os chunks que o diário diz estarem prontos, quando há manifesto
+    if digests is None:
+        return concluidos
+    validos = set()
+    with open(caminho_parcial, "rb") as f:
+        for indice in concluidos:
+            f.seek(indice * TAMANHO_CHUNK)
+            conteudo = f.read(min(TAMANHO_CHUNK, tamanho - indice * TAMANHO_CHUNK))
+            if hashlib.sha256(conteudo).hexdigest() == digests[indice]:
+                validos.add(indice)
+    return validos
+
+def realizar_download(fontes, nome_arquivo, tamanho, clock, endereco_porta, diretorio, pool):
+    # Divide o arquivo em chunks de TAMANHO_CHUNK e distribui entre todas as fontes.
+    # Cada trabalhador pega o próximo chunk livre, então fontes lentas acabam pegando menos;
+    # no fim, trabalhadores ociosos repetem chunks ainda em andamento em outras fontes.
+    # Os chunks vão para <nome>.part e cada um concluído é anotado em <nome>.part.chunks,
+    # então um download interrompido é retomado pedindo só o que falta.
+    total_chunks = max(1, -(-tamanho // TAMANHO_CHUNK))
+    caminho = os.path.join(diretorio, nome_arquivo)
+    caminho_parcial = caminho + SUFIXO_PARCIAL
+    caminho_diario = caminho + SUFIXO_DIARIO
+    lock = threading.Lock()
+    tentativas = collections.defaultdict(set)  # indice -> fontes que já pediram esse chunk
+    fontes_invalidas = set()  # fontes que mandaram algum chunk diferente do manifesto
+    digests = obter_manifesto(fontes, nome_arquivo, clock, endereco_porta, pool)
+    if digests is not None and len(digests) != total_chunks:
+        digests = None
+
+    concluidos = ler_diario(caminho_diario, tamanho) if os.path.exists(caminho_parcial) else None
+    if concluidos is not None:
+        concluidos = chunks_validos(caminho_parcial, concluidos & set(range(total_chunks)), tamanho, digests)
+        print(f"Retomando download de {nome_arquivo}: {len(concluidos)} de {total_chunks} chunk(s) já baixados")
+    else:
+        concluidos = set()
+        with open(caminho_parcial, "wb") as f:
+            f.truncate(tamanho)
+        with open(caminho_diario, "w") as diario:
+            diario.write(f"{tamanho} {TAMANHO_CHUNK}\n")
+    faltando = set(range(total_chunks)) - concluidos
+    pendentes = collections.deque(sorted(faltando))
+
+    def proximo_chunk(fonte):
+        with lock:
+            while pendentes:
+                indice = pendentes.popleft()
+                if indice in faltando:
+                    tentativas[indice].add(fonte)
+                    return indice
+            for indice in faltando:
+                if fonte not in tentativas[indice]:
+                    tentativas[indice].add(fonte)
+                    return indice
+            return None
+
+    def trabalhador(f, diario, fonte):
+        ocupado = 0  # BUSY seguidos desta fonte
+        while fonte.estado == ONLINE and fonte not in fontes_invalidas:
+            indice = proximo_chunk(fonte)
+            if indice is None:
+                return
+            try:
+                partes = baixar_chunk(fonte.endereco, fonte.porta, nome_arquivo, indice, tamanho, clock, endereco_porta, pool)
+            except PeerOcupado:
+                # Fonte sobrecarregada: devolve o chunk para outra fonte e tenta de novo depois,
+                # com espera crescente; depois de TENTATIVAS_OCUPADO recusas seguidas desiste dela
+                with lock:
+                    if indice in faltando:
+                        pendentes.append(indice)
+                ocupado += 1
+                if ocupado > TENTATIVAS_OCUPADO:
+                    print(f"Peer {fonte.endereco}:{fonte.porta} ocupado, deixando a fonte de lado")
+                    return
+                time.sleep(ESPERA_OCUPADO * 2 ** (ocupado - 1))
+                continue
+            except Exception as e:
+                print(f"Falha ao baixar chunk {indice} de {fonte.endereco}:{fonte.porta}: {e}")
+                with lock:
+                    if indice in faltando:
+                        pendentes.append(indice)
+                fonte.atualizar_estado(OFFLINE)
+                return
+            ocupado = 0
+            if digests is not None and any(hashlib.sha256(conteudo).hexdigest() != digests[i] for i, conteudo in partes):
+                # Conteúdo diferente do manifesto: descarta a fonte para este arquivo
+                print(f"Chunk {indice} de {fonte.endereco}:{fonte.porta} não confere com o hash esperado")
+                with lock:
+                    fontes_invalidas.add(fonte)
+                    if indice in faltando:
+                        pendentes.append(indice)
+                return
+            with lock:
+                for i, conteudo in partes:
+                    if i not in faltando:
+                        continue
+                    f.seek(i * TAMANHO_CHUNK)
+                    f.write(conteudo)
+                    diario.write(f"{i}\n")
+                    faltando.discard(i)
+                f.flush()
+                diario.flush()
+
+    verificacao = "com verificação de hash" if digests is not None else "sem manifesto de hash"
+    print(f"Baixando {nome_arquivo} em {total_chunks} chunk(s) de {len(fontes)} peer(s), {verificacao}")
+    try:
+        with open(caminho_parcial, "r+b") as f, open(caminho_diario, "a") as diario:
+            total_trabalhadores = max(MAX_DOWNLOADS_PARALELOS, len(fontes))
+            with ThreadPoolExecutor(max_workers=total_trabalhadores) as executor:
+                futuros = [executor.submit(trabalhador, f, diario, fontes[i % len(fontes)]) for i in range(total_trabalhadores)]
+                for futuro in as_completed(futuros):
+                    futuro.result()
+        if faltando:
+            print(f"Erro no download: {len(faltando)} chunk(s) sem fonte disponível. Busque o arquivo de novo para retomar.")
+            return
+        os.replace(caminho_parcial, caminho)
+        os.remove(caminho_diario)
+        print(f"Download do arquivo {nome_arquivo} finalizado.")
     except Exception as e:
         print(f"Erro no download: {e}")
 
-def processar_conexao(conexao, endereco, clock, lista_vizinhos, diretorio_compartilhado):
-    dados = conexao.recv(4096).decode()
-    if not dados:
+class SessaoServidor:
+    # Uma conexão atendida pelo servidor e o que precisa sobreviver entre uma mensagem e outra
+    def __init__(self, conexao, endereco):
+        self.conexao = conexao
+        self.endereco = endereco
+        self.leitor = LeitorSocket(conexao)
+        self.binario = False  # formato das respostas, trocado pela negociação HELLO BIN
+        self.ultimo_uso = time.monotonic()
+
+def atender_mensagem(sessao, clock, lista_vizinhos, indice_arquivos, inundacao):
+    # Lê e responde a próxima mensagem da conexão (ou um BATCH inteiro).
+    # Devolve False quando a conexão acabou e deve ser fechada.
+    conexao, endereco, leitor = sessao.conexao, sessao.endereco, sessao.leitor
+    try:
+        mensagem = leitor.ler_mensagem()
+    except ValueError as e:
+        print(f"Mensagem inválida recebida de {endereco[0]}:{endereco[1]}: {e}")
+        return True
+    except OSError:
+        return False
+    if mensagem is None:
+        return False
+    if mensagem.tipo == "BATCH":
+        try:
+            mensagens = [leitor.ler_mensagem() for _ in range(tamanho_lote(mensagem))]
+        except ValueError as e:
+            print(f"Lote inválido recebido de {endereco[0]}:{endereco[1]}: {e}")
+            return False
+        except OSError:
+            return False
+        if None in mensagens:
+            return False
+        try:
+            enviar_respostas(conexao, tratar_lote(endereco, mensagens, clock, lista_vizinhos, indice_arquivos, inundacao), sessao.binario)
+        except OSError as e:
+            print(f"Erro ao responder {endereco[0]}:{endereco[1]}: {e}")
+            return False
+        return True
+    try:
+        resposta = tratar_mensagem(endereco, mensagem, clock, lista_vizinhos, indice_arquivos, inundacao)
+        sessao.binario = sessao.binario or (isinstance(resposta, Mensagem) and resposta.tipo == "HELLO_BIN")
+        enviar_resposta(conexao, resposta, sessao.binario)
+    except OSError as e:
+        # Inclusive arquivo alterado no meio de um DL: fechar a conexão faz o cliente
+        # desistir do chunk na hora, em vez de esperar bytes que não virão
+        print(f"Erro ao responder {endereco[0]}:{endereco[1]}: {e}")
+        return False
+    return True
+
+def processar_conexao(conexao, endereco, clock, lista_vizinhos, indice_arquivos, inundacao):
+    # Atende todas as mensagens da conexão, em ordem, até o outro lado encerrá-la
+    # ou ela ficar ociosa por TEMPO_OCIOSO_SERVIDOR
+    conexao.settimeout(TEMPO_OCIOSO_SERVIDOR)
+    sessao = SessaoServidor(conexao, endereco)
+    with conexao:
+        while atender_mensagem(sessao, clock, lista_vizinhos, indice_arquivos, inundacao):
+            pass
+
+def enviar_respostas(conexao, respostas, binario=False):
+    # Mensagens seguidas vão numa única escrita; respostas de arquivo saem do jeito de sempre
+    pendente = bytearray()
+    for resposta in respostas:
+        if isinstance(resposta, Mensagem):
+            pendente += resposta.codificar(binario)
+            continue
+        if pendente:
+            conexao.sendall(pendente)
+            pendente.clear()
+        enviar_resposta(conexao, resposta, binario)
+    if pendente:
+        conexao.sendall(pendente)
+
+def enviar_resposta(conexao, resposta, binario=False):
+    if resposta is None:
+        return
+    if isinstance(resposta, Mensagem):
+        conexao.sendall(resposta.codificar(binario))
         return
-    mensagem = Mensagem.analisar_mensagem(dados)
-    clock.atualizar(mensagem.clock)
-    print(f"Mensagem recebida: {dados.strip()}")
+    if isinstance(resposta, RespostaArquivo):
+        conexao.sendall(resposta.cabecalho.codificar(binario))
+        if resposta.comprimento:
+            with open(resposta.caminho, "rb") as f:
+                enviados = conexao.sendfile(f, resposta.inicio, resposta.comprimento)
+            if enviados != resposta.comprimento:
+                # Arquivo encurtado depois de indexado
+                raise ConnectionError(f"Arquivo '{resposta.caminho}' mudou durante o envio")
+        return
+    if isinstance(resposta, list):
+        for parte in resposta:
+            conexao.sendall(parte)
+        return
+    conexao.sendall(resposta)
+
+async def atender_conexao_async(leitor, escritor, clock, lista_vizinhos, indice_arquivos, inundacao):
+    # Equivalente a processar_conexao, mas como corrotina no loop de eventos
+    endereco = escritor.get_extra_info("peername")
+    binario = False
+    try:
+        while True:
+            try:
+                mensagem = await asyncio.wait_for(ler_mensagem_async(leitor), TEMPO_OCIOSO_SERVIDOR)
+            except ValueError as e:
+                print(f"Mensagem inválida recebida de {endereco[0]}:{endereco[1]}: {e}")
+                continue
+            if mensagem is None:
+                return
+            if mensagem.tipo == "BATCH":
+                mensagens = [await asyncio.wait_for(ler_mensagem_async(leitor), TEMPO_OCIOSO_SERVIDOR) for _ in range(tamanho_lote(mensagem))]
+                if None in mensagens:
+                    return
+                respostas = await tratar_async(tratar_lote, endereco, mensagens, clock, lista_vizinhos, indice_arquivos, inundacao, com_dl=any(m.tipo == "DL" for m in mensagens))
+                for resposta in respostas:
+                    if isinstance(resposta, Mensagem):
+                        # Sem drain entre as mensagens: saem juntas do buffer do transporte
+                        escritor.write(resposta.codificar(binario))
+                    else:
+                        await enviar_resposta_async(escritor, resposta, binario)
+                await escritor.drain()
+                continue
+            resposta = await tratar_async(tratar_mensagem, endereco, mensagem, clock, lista_vizinhos, indice_arquivos, inundacao, com_dl=mensagem.tipo == "DL")
+            binario = binario or (isinstance(resposta, Mensagem) and resposta.tipo == "HELLO_BIN")
+            await enviar_resposta_async(escritor, resposta, binario)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError, ValueError):
+        pass
+    finally:
+        escritor.close()
+
+async def tratar_async(funcao, *argumentos, com_dl=False):
+    # DL em base64 lê e codifica o trecho inteiro do arquivo (o arquivo todo, no DL <nome> 0 0
+    # de peers antigos); isso roda numa thread para não parar as outras conexões do loop
+    if not com_dl:
+        return funcao(*argumentos)
+    return await asyncio.get_running_loop().run_in_executor(None, funcao, *argumentos)
+
+async def ler_mensagem_async(leitor):
+    # Próxima mensagem (texto ou quadro binário), ou None quando o outro lado encerrar
+    while True:
+        primeiro = await leitor.read(1)
+        if not primeiro:
+            return None
+        if primeiro[0] == MARCA_BINARIA:
+            cabecalho = primeiro + await leitor.readexactly(CABECALHO_BINARIO.size - 1)
+            corpo = await leitor.readexactly(CABECALHO_BINARIO.unpack(cabecalho)[-1])
+            return Mensagem.analisar_binario(cabecalho, corpo)
+        linha = primeiro + await leitor.readline()
+        if linha.strip():
+            return Mensagem.analisar_mensagem(linha.decode())
+
+async def enviar_resposta_async(escritor, resposta, binario=False):
+    if resposta is None:
+        return
+    if isinstance(resposta, Mensagem):
+        escritor.write(resposta.codificar(binario))
+        await escritor.drain()
+        return
+    if isinstance(resposta, RespostaArquivo):
+        escritor.write(resposta.cabecalho.codificar(binario))
+        await escritor.drain()
+        if resposta.comprimento:
+            with open(resposta.caminho, "rb") as f:
+                enviados = await asyncio.get_running_loop().sendfile(escritor.transport, f, resposta.inicio, resposta.comprimento)
+            if enviados != resposta.comprimento:
+                raise ConnectionError(f"Arquivo '{resposta.caminho}' mudou durante o envio")
+        return
+    if isinstance(resposta, list):
+        escritor.writelines(resposta)
+        await escritor.drain()
+        return
+    escritor.write(resposta)
+    await escritor.drain()
+
+class RespostaArquivo:
+    # Resposta FILE_RAW: cabeçalho (Mensagem) seguido de um trecho do arquivo enviado direto do disco
+    def __init__(self, cabecalho, caminho, inicio, comprimento):
+        self.cabecalho = cabecalho
+        self.caminho = caminho
+        self.inicio = inicio
+        self.comprimento = comprimento
+
+def tamanho_lote(envelope):
+    # BATCH <n>: as n mensagens seguintes da conexão formam o lote
+    quantidade = int(envelope.argumentos[0]) if envelope.argumentos else 0
+    if not 0 < quantidade <= MAX_LOTE:
+        raise ValueError(f"Lote com {quantidade} mensagens")
+    return quantidade
+
+def tratar_lote(endereco, mensagens, clock, lista_vizinhos, indice_arquivos, inundacao):
+    # Cada mensagem do lote é respondida em ordem, com o relógio atualizado por cada uma como
+    # se tivessem chegado separadas. Devolve BATCH_REPLY <n> seguido de uma resposta por
+    # mensagem, com ACK no lugar das que não têm resposta; o ACK leva o relógio da sua
+    # mensagem e o BATCH_REPLY o da última.
+    respostas = []
+    for mensagem in mensagens:
+        valor = clock.atualizar(mensagem.clock)
+        resposta = responder_mensagem(endereco, mensagem, valor, lista_vizinhos, indice_arquivos, inundacao)
+        if resposta is None:
+            resposta = Mensagem(f"{endereco[0]}:{endereco[1]}", valor, "ACK", [mensagem.tipo])
+        respostas.append(resposta)
+    return [Mensagem(f"{endereco[0]}:{endereco[1]}", valor, "BATCH_REPLY", [str(len(respostas))])] + respostas
+
+def tratar_mensagem(endereco, mensagem, clock, lista_vizinhos, indice_arquivos, inundacao):
+    # Processa uma mensagem recebida e devolve a resposta a enviar (Mensagem, codificada
+    # no formato da conexão; lista de partes em bytes; RespostaArquivo ou None)
+    valor = clock.atualizar(mensagem.clock)
+    return responder_mensagem(endereco, mensagem, valor, lista_vizinhos, indice_arquivos, inundacao)
+
+def responder_mensagem(endereco, mensagem, valor, lista_vizinhos, indice_arquivos, inundacao):
+    # valor: o relógio devolvido pela atualização feita com esta mensagem, usado nas respostas
+    print(f"Mensagem recebida: {mensagem.construir_mensagem().strip()}")
 
     origem = mensagem.origem
     tipo = mensagem.tipo
     endereco_remetente, porta_remetente = origem.split(":")
     porta_remetente = int(porta_remetente)
-    peer_existente = next((p for p in lista_vizinhos if p.endereco == endereco_remetente and p.porta == porta_remetente), None)
-    if not peer_existente:
+    if tipo in ("QUERY", "QUERY_HIT") and lista_vizinhos.obter(endereco_remetente, porta_remetente) is None:
+        # Quem só participa de uma busca por inundação não vira vizinho (nem se espalha pelo
+        # PEER_LIST): a inundação existe para que nem todo nó precise conhecer todos os outros.
+        # O Peer avulso serve só de fonte de download para o QUERY_HIT.
         peer_existente = Peer(endereco_remetente, porta_remetente)
-        lista_vizinhos.append(peer_existente)
-
-    peer_existente.atualizar_estado("ONLINE")
-    peer_existente.atualizar_relogio(mensagem.clock)
-
-    if tipo == "HELLO":
-        # Atualiza ou adiciona peer como ONLINE
-        peer_existente = next((p for p in lista_vizinhos if p.endereco == origem.split(":")[0] and p.porta == int(origem.split(":")[1])), None)
-        if peer_existente:
-            peer_existente.atualizar_estado("ONLINE")
-        else:
-            novo_peer = Peer(origem.split(":")[0], int(origem.split(":")[1]))
-            novo_peer.atualizar_estado("ONLINE")
-            lista_vizinhos.append(novo_peer)
+        peer_existente.estado = ONLINE
+    else:
+        peer_existente, _ = lista_vizinhos.obter_ou_criar(endereco_remetente, porta_remetente)
+        # Qualquer outra mensagem (inclusive HELLO) coloca o remetente como ONLINE
+        peer_existente.atualizar_estado(ONLINE)
+        peer_existente.atualizar_relogio(mensagem.clock)
 
-    elif tipo == "GET_PEERS":
-        # Responde com a lista atual de peers
+    if tipo == "GET_PEERS":
+        # GET_PEERS responde com a lista atual inteira; GET_PEERS <versao> só com o que mudou depois
+        # dela, em PEER_DELTA <versao_atual> <n> <entradas>
         endereco_str = f"{endereco[0]}:{endereco[1]}"
+        if mensagem.argumentos:
+            versao, peers = lista_vizinhos.alteracoes_desde(mensagem.argumentos[0])
+            tipo_resposta, cabecalho = "PEER_DELTA", [versao, str(len(peers))]
+        else:
+            peers = list(lista_vizinhos)
+            tipo_resposta, cabecalho = "PEER_LIST", [str(len(peers))]
         resposta = Mensagem(
             endereco_str,
-            clock.valor,
-            "PEER_LIST",
-            [str(len(lista_vizinhos))] + [f"{p.endereco}:{p.porta}:{p.estado}:{p.relogio}" for p in lista_vizinhos]
-        ).construir_mensagem()
-        conexao.sendall(resposta.encode())
+            valor,
+            tipo_resposta,
+            cabecalho + [entrada_peer(p) for p in peers]
+        )
+        return resposta
+
+    elif tipo == "PEER_PUSH":
+        # Alterações empurradas pela anti-entropia de um vizinho; não há resposta
+        processar_peer_list(mensagem.argumentos[1:], lista_vizinhos, silencioso=True)
+        return None
 
     elif tipo == "LIST_FILES":
-        arquivos = os.listdir(diretorio_compartilhado)
-        resposta = Mensagem(endereco, clock.valor, "FILE_LIST", arquivos).construir_mensagem()
-        conexao.sendall(resposta.encode())
+        arquivos = indice_arquivos.nomes()
+        return Mensagem(f"{endereco[0]}:{endereco[1]}", valor, "FILE_LIST", arquivos)
     
+    elif tipo == "HELLO" and mensagem.argumentos[:1] in (["BIN"], ["TEXTO"]):
+        # Negociação: com BIN quem atende a conexão passa a responder em binário. A resposta
+        # anuncia o que este peer atende além do protocolo original.
+        tipo_resposta = "HELLO_BIN" if mensagem.argumentos[0] == "BIN" else "HELLO_TEXTO"
+        return Mensagem(f"{endereco[0]}:{endereco[1]}", valor, tipo_resposta, list(CAPACIDADES))
+
     elif tipo == "BYE":
         # Marca peer como OFFLINE
-        peer_existente = next((p for p in lista_vizinhos if p.endereco == origem.split(":")[0] and p.porta == int(origem.split(":")[1])), None)
-        if peer_existente:
-            peer_existente.atualizar_estado("OFFLINE")
+        peer_existente.atualizar_estado(OFFLINE)
 
     if tipo == "LS":
-        arquivos = os.listdir(diretorio_compartilhado)
-        lista_arquivos = [f"{nome}:{os.path.getsize(os.path.join(diretorio_compartilhado, nome))}" for nome in arquivos]
-        resposta = Mensagem(f"{endereco[0]}:{endereco[1]}", clock.valor, "LS_LIST", [str(len(lista_arquivos))] + lista_arquivos).construir_mensagem()
-        conexao.sendall(resposta.encode())
+        # Payload já montado pelo índice, sem tocar no disco. Com LS <versao>, o cliente
+        # informa a versão que já tem: se nada mudou a resposta é só LS_NOT_MODIFIED;
+        # senão vai LS_LIST_V <versao> com a lista. LS sem argumento segue como antes.
+        origem_resposta = f"{endereco[0]}:{endereco[1]}"
+        if not mensagem.argumentos:
+            return Mensagem(origem_resposta, valor, "LS_LIST", indice_arquivos.itens_ls, indice_arquivos.carga_ls)
+        versao = indice_arquivos.identificador_versao()
+        if mensagem.argumentos[0] == versao:
+            return Mensagem(origem_resposta, valor, "LS_NOT_MODIFIED", [versao])
+        return Mensagem(origem_resposta, valor, "LS_LIST_V", [versao] + indice_arquivos.itens_ls, f"{versao} {indice_arquivos.carga_ls}")
+
+    elif tipo == "SEARCH":
+        # SEARCH <palavra>... -> SEARCH_LIST <n> <nome:tamanho>... só com os arquivos que contêm todas
+        encontrados = indice_arquivos.buscar(palavras_nome(" ".join(mensagem.argumentos)))
+        resposta = Mensagem(
+            f"{endereco[0]}:{endereco[1]}",
+            valor,
+            "SEARCH_LIST",
+            [str(len(encontrados))] + [f"{nome}:{tamanho}" for nome, tamanho in encontrados]
+        )
+        return resposta
+
+    elif tipo == "QUERY":
+        # Busca por inundação: nada volta por esta conexão, os acertos vão direto para a origem
+        inundacao.receber_consulta(origem, mensagem.argumentos)
+        return None
+
+    elif tipo == "QUERY_HIT":
+        inundacao.receber_resultado(peer_existente, mensagem.argumentos)
+        return None
+
+    elif tipo == "HASH":
+        # HASH <nome> -> HASH_LIST <nome> <tamanho_chunk> <digest_total> <n> <digest_chunk>...
+        nome_arquivo = mensagem.argumentos[0]
+        manifesto = indice_arquivos.manifestos.obter(nome_arquivo)
+        if manifesto is None:
+            return Mensagem(f"{endereco[0]}:{endereco[1]}", valor, "HASH_NONE", [nome_arquivo])
+        return Mensagem(
+            f"{endereco[0]}:{endereco[1]}",
+            valor,
+            "HASH_LIST",
+            [nome_arquivo, str(manifesto["tamanho_chunk"]), manifesto["total"], str(len(manifesto["chunks"]))] + manifesto["chunks"]
+        )
 
     elif tipo == "DL":
+        # DL <nome> <tamanho_chunk> <indice> [RAW]; tamanho_chunk 0 pede o arquivo inteiro
         nome_arquivo = mensagem.argumentos[0]
-        caminho = os.path.join(diretorio_compartilhado, nome_arquivo)
-        if os.path.exists(caminho):
-            with open(caminho, "rb") as f:
-                conteudo = f.read()
-            conteudo_b64 = base64.b64encode(conteudo).decode()
-            resposta = Mensagem(f"{endereco[0]}:{endereco[1]}", clock.valor, "FILE", [nome_arquivo, "0", "0", conteudo_b64]).construir_mensagem()
-            conexao.sendall(resposta.encode())
+        tamanho_chunk = int(mensagem.argumentos[1]) if len(mensagem.argumentos) > 1 else 0
+        indice = int(mensagem.argumentos[2]) if len(mensagem.argumentos) > 2 else 0
+        modo_raw = len(mensagem.argumentos) > 3 and mensagem.argumentos[3] == "RAW"
+        tamanho_arquivo = indice_arquivos.tamanho(nome_arquivo)
+        if tamanho_arquivo is not None:
+            caminho = os.path.join(indice_arquivos.diretorio, nome_arquivo)
+            inicio = min(indice * tamanho_chunk, tamanho_arquivo)
+            comprimento = min(tamanho_chunk, tamanho_arquivo - inicio) if tamanho_chunk > 0 else tamanho_arquivo
+            if modo_raw:
+                # Cabeçalho seguido dos bytes crus, enviados direto do arquivo pelo kernel
+                cabecalho = Mensagem(f"{endereco[0]}:{endereco[1]}", valor, "FILE_RAW", [nome_arquivo, str(tamanho_chunk), str(indice), str(comprimento)])
+                return RespostaArquivo(cabecalho, caminho, inicio, comprimento)
+            # O base64 é gerado direto do trecho lido e enviado em partes,
+            # sem copiar o conteúdo para montar uma única string de resposta.
+            # Chunks pedidos de novo saem prontos do cache, sem ler o disco nem recodificar.
+            _, mtime = indice_arquivos.arquivos[nome_arquivo]
+            chave = (nome_arquivo, tamanho_arquivo, mtime, tamanho_chunk, indice)
+            conteudo_b64 = indice_arquivos.cache_chunks.obter(chave)
+            if conteudo_b64 is None:
+                trecho = indice_arquivos.ler_trecho(nome_arquivo, inicio, comprimento)
+                conteudo_b64 = base64.b64encode(trecho)
+                indice_arquivos.cache_chunks.guardar(chave, conteudo_b64)
+            cabecalho = Mensagem(f"{endereco[0]}:{endereco[1]}", valor, "FILE", [nome_arquivo, str(tamanho_chunk), str(indice)]).construir_mensagem()
+            return [cabecalho.rstrip("\n").encode() + b" ", conteudo_b64, b"\n"]
 
 
 def configurar_socket(endereco_porta):
@@ -290,29 +2166,161 @@ def configurar_socket(endereco_porta):
     print(f"Peer escutando em {endereco}:{porta}")
     return servidor
 
-def aceitar_conexoes(servidor, clock, lista_vizinhos, diretorio):
+def aceitar_conexoes(servidor, clock, lista_vizinhos, indice_arquivos, inundacao):
     while True:
         conexao, endereco = servidor.accept()
-        threading.Thread(target=processar_conexao, args=(conexao, endereco, clock, lista_vizinhos, diretorio)).start()
+        threading.Thread(target=processar_conexao, args=(conexao, endereco, clock, lista_vizinhos, indice_arquivos, inundacao)).start()
+
+def atender_fila(fila, espera, clock, lista_vizinhos, indice_arquivos, inundacao):
+    # Trabalhador do modo pool: responde o que já chegou numa conexão da fila e a devolve
+    # à espera, em vez de ficar preso a ela até a conexão ficar ociosa
+    while True:
+        sessao = fila.get()
+        try:
+            continuar = atender_mensagem(sessao, clock, lista_vizinhos, indice_arquivos, inundacao)
+            # Mensagens que chegaram juntas já estão no buffer e não acordariam o selector
+            while continuar and sessao.leitor.buffer:
+                continuar = atender_mensagem(sessao, clock, lista_vizinhos, indice_arquivos, inundacao)
+        except Exception as e:
+            print(f"Erro ao atender {sessao.endereco[0]}:{sessao.endereco[1]}: {e}")
+            continuar = False
+        if continuar:
+            espera.devolver(sessao)
+        else:
+            sessao.conexao.close()
+
+def recusar_conexao(conexao, endereco, clock):
+    # O BUSY é um envio como outro qualquer: leva um incremento próprio do relógio
+    valor = clock.incrementar()
+    resposta = Mensagem(f"{endereco[0]}:{endereco[1]}", valor, "BUSY").construir_mensagem()
+    with conexao:
+        try:
+            conexao.sendall(resposta.encode())
+        except OSError:
+            pass
+
+class EsperaConexoes:
+    # Conexões do modo pool sem mensagem pendente ficam num selector, fora dos trabalhadores.
+    # Só uma conexão com dados chegados entra na fila; com a fila cheia ela espera um pouco
+    # (o que também segura novos accepts) e, se ainda não couber, recebe BUSY e é fechada.
+    # Conexões paradas por TEMPO_OCIOSO_SERVIDOR são fechadas aqui mesmo.
+    def __init__(self, servidor, fila, clock):
+        self.servidor = servidor
+        self.fila = fila
+        self.clock = clock
+        self.seletor = selectors.DefaultSelector()
+        self.devolvidas = queue.SimpleQueue()
+        # Trabalhadores acordam o select ao devolver uma conexão por este par de sockets
+        self.despertador, self.despertar = socket.socketpair()
 
-def inicializar_vizinhos(arquivo_vizinhos):
-    lista = []
+    def devolver(self, sessao):
+        sessao.ultimo_uso = time.monotonic()
+        self.devolvidas.put(sessao)
+        self.despertar.send(b"\0")
+
+    def enfileirar(self, sessao):
+        try:
+            self.fila.put(sessao, timeout=ESPERA_FILA_SERVIDOR)
+        except queue.Full:
+            endereco = sessao.endereco
+            print(f"Fila cheia, recusando conexão de {endereco[0]}:{endereco[1]}")
+            recusar_conexao(sessao.conexao, endereco, self.clock)
+
+    def fechar_ociosas(self):
+        agora = time.monotonic()
+        for chave in list(self.seletor.get_map().values()):
+            sessao = chave.data
+            if isinstance(sessao, SessaoServidor) and agora - sessao.ultimo_uso >= TEMPO_OCIOSO_SERVIDOR:
+                self.seletor.unregister(sessao.conexao)
+                sessao.conexao.close()
+
+    def executar(self):
+        self.seletor.register(self.servidor, selectors.EVENT_READ, "aceitar")
+        self.seletor.register(self.despertador, selectors.EVENT_READ, "despertar")
+        while True:
+            for chave, _ in self.seletor.select(timeout=1):
+                if chave.data == "aceitar":
+                    conexao, endereco = self.servidor.accept()
+                    # Uma mensagem que começou a chegar não pode prender o trabalhador por muito tempo
+                    conexao.settimeout(TIMEOUT_CONEXAO)
+                    self.seletor.register(conexao, selectors.EVENT_READ, SessaoServidor(conexao, endereco))
+                elif chave.data == "despertar":
+                    self.despertador.recv(4096)
+                    while True:
+                        try:
+                            sessao = self.devolvidas.get_nowait()
+                        except queue.Empty:
+                            break
+                        self.seletor.register(sessao.conexao, selectors.EVENT_READ, sessao)
+                else:
+                    self.seletor.unregister(chave.fileobj)
+                    self.enfileirar(chave.data)
+            self.fechar_ociosas()
+
+def aceitar_conexoes_pool(servidor, clock, lista_vizinhos, indice_arquivos, inundacao):
+    # Número fixo de trabalhadores e fila limitada de conexões com mensagem para responder
+    fila = queue.Queue(maxsize=TAMANHO_FILA_SERVIDOR)
+    espera = EsperaConexoes(servidor, fila, clock)
+    for _ in range(TRABALHADORES_SERVIDOR):
+        threading.Thread(target=atender_fila, args=(fila, espera, clock, lista_vizinhos, indice_arquivos, inundacao), daemon=True).start()
+    espera.executar()
+
+async def servir_async(servidor, clock, lista_vizinhos, indice_arquivos, inundacao):
+    # Um único loop de eventos atende todas as conexões, sem uma thread por conexão
+    async def atender(leitor, escritor):
+        await atender_conexao_async(leitor, escritor, clock, lista_vizinhos, indice_arquivos, inundacao)
+
+    servidor_async = await asyncio.start_server(atender, sock=servidor, limit=LIMITE_LINHA_ASYNC)
+    async with servidor_async:
+        await servidor_async.serve_forever()
+
+def iniciar_servidor(servidor, modo, clock, lista_vizinhos, indice_arquivos, inundacao):
+    if modo == "asyncio":
+        alvo, args = asyncio.run, (servir_async(servidor, clock, lista_vizinhos, indice_arquivos, inundacao),)
+    elif modo == "pool":
+        alvo, args = aceitar_conexoes_pool, (servidor, clock, lista_vizinhos, indice_arquivos, inundacao)
+    else:
+        alvo, args = aceitar_conexoes, (servidor, clock, lista_vizinhos, indice_arquivos, inundacao)
+    threading.Thread(target=alvo, args=args, daemon=True).start()
+
+def ler_opcoes(argumentos):
+    # Opções extras no formato --chave=valor, depois dos três parâmetros obrigatórios
+    opcoes = {}
+    for argumento in argumentos:
+        if not argumento.startswith("--") or "=" not in argumento:
+            raise ValueError(f"Opção inválida: {argumento}")
+        chave, valor = argumento[2:].split("=", 1)
+        opcoes[chave] = valor
+    return opcoes
+
+def inicializar_vizinhos(arquivo_vizinhos, compacto=False, hlc=None):
+    lista = RegistroPeers(compacto, hlc)
     with open(arquivo_vizinhos, "r") as f:
         for linha in f:
             if linha.strip():
                 endereco, porta = linha.strip().split(":")
-                peer = Peer(endereco, int(porta))
+                peer, _ = lista.obter_ou_criar(endereco, int(porta))
                 print(f"Adicionando novo peer {endereco}:{porta} status {peer.estado}")
-                lista.append(peer)
     return lista
 
-def menu(lista_vizinhos, endereco_porta, clock, diretorio, servidor):
+def exibir_estatisticas(indice_arquivos):
+    cache = indice_arquivos.cache_chunks.estatisticas()
+    pedidos = cache["acertos"] + cache["falhas"]
+    taxa = 100 * cache["acertos"] / pedidos if pedidos else 0
+    print("\nCache de chunks do servidor:")
+    print(f"Acertos: {cache['acertos']} | Falhas: {cache['falhas']} | Taxa de acerto: {taxa:.1f}%")
+    print(f"Chunks guardados: {cache['itens']} | Bytes: {cache['bytes']} de {indice_arquivos.cache_chunks.orcamento}")
+
+def menu(lista_vizinhos, endereco_porta, clock, indice_arquivos, servidor, pool, cache_busca, inundacao, indice_resultados):
     while True:
         print("\nEscolha um comando:")
         print("[1] Listar peers")
         print("[2] Obter peers")
         print("[3] Listar arquivos locais")
         print("[4] Buscar arquivos")
+        print("[5] Exibir estatisticas")
+        print("[6] Buscar arquivos por inundacao")
+        print("[7] Buscar arquivos por palavra-chave")
         print("[9] Sair")
         escolha = input("> ")
 
@@ -321,47 +2329,83 @@ def menu(lista_vizinhos, endereco_porta, clock, diretorio, servidor):
                 print(f"[{i}] {p.endereco}:{p.porta} {p.estado}")
             opt = input("Escolha um peer para enviar HELLO ou 0 para voltar: ")
             if opt.isdigit() and 0 < int(opt) <= len(lista_vizinhos):
-                enviar_hello(lista_vizinhos[int(opt)-1], endereco_porta, clock)
+                enviar_hello(lista_vizinhos[int(opt)-1], endereco_porta, clock, pool)
         elif escolha == "2":
-            obter_peers(lista_vizinhos, endereco_porta, clock)
+            obter_peers(lista_vizinhos, endereco_porta, clock, pool)
         elif escolha == "3":
-            listar_arquivos(diretorio)
+            listar_arquivos(indice_arquivos)
         elif escolha == "4":
-            buscar_arquivos(lista_vizinhos, endereco_porta, clock)
+            buscar_arquivos(lista_vizinhos, endereco_porta, clock, indice_arquivos, pool, cache_busca)
+        elif escolha == "5":
+            exibir_estatisticas(indice_arquivos)
+        elif escolha == "6":
+            buscar_por_inundacao(inundacao, clock, endereco_porta, indice_arquivos, pool)
+        elif escolha == "7":
+            buscar_palavras(lista_vizinhos, endereco_porta, clock, indice_arquivos, pool, indice_resultados)
         elif escolha == "9":
-            for peer in lista_vizinhos:
-                if peer.estado == "ONLINE":
-                    clock.incrementar()
-                    mensagem = Mensagem(endereco_porta, clock.valor, "BYE").construir_mensagem()
-                    print(f"Encaminhando mensagem \"{mensagem.strip()}\" para {peer.endereco}:{peer.porta}")
-                    try:
-                        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as cliente:
-                            cliente.settimeout(5)
-                            cliente.connect((peer.endereco, peer.porta))
-                            cliente.sendall(mensagem.encode())
-                    except:
-                        pass
-            servidor.close()
-            print("Encerrando peer.")
-            sys.exit(0)
+            sair(lista_vizinhos, endereco_porta, clock, servidor, pool)
         else:
             print("Comando inválido.")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Uso: python <script>.py <endereco:porta> <arquivo_vizinhos.txt> <diretorio_compartilhado>")
+    if len(sys.argv) < 4:
+        print("Uso: python <script>.py <endereco:porta> <arquivo_vizinhos.txt> <diretorio_compartilhado> [--servidor=threads|asyncio|pool] [--peers=objetos|compacto] [--protocolo=texto|binario] [--relogio=lamport|hlc] [--heartbeat=<segundos>] [--anti-entropia=<segundos>]")
         sys.exit(1)
 
     endereco_porta = sys.argv[1]
     vizinhos_path = sys.argv[2]
     diretorio = sys.argv[3]
 
+    try:
+        opcoes = ler_opcoes(sys.argv[4:])
+    except ValueError as e:
+        print(f"Erro: {e}")
+        sys.exit(1)
+    modo_servidor = opcoes.get("servidor", "threads")
+    if modo_servidor not in MODOS_SERVIDOR:
+        print(f"Erro: modo de servidor inválido '{modo_servidor}'.")
+        sys.exit(1)
+    armazenamento_peers = opcoes.get("peers", "objetos")
+    if armazenamento_peers not in ("objetos", "compacto"):
+        print(f"Erro: armazenamento de peers inválido '{armazenamento_peers}'.")
+        sys.exit(1)
+    modo_relogio = opcoes.get("relogio", "lamport")
+    if modo_relogio not in MODOS_RELOGIO:
+        print(f"Erro: modo de relógio inválido '{modo_relogio}'.")
+        sys.exit(1)
+    protocolo = opcoes.get("protocolo", "texto")
+    if protocolo not in MODOS_PROTOCOLO:
+        print(f"Erro: protocolo inválido '{protocolo}'.")
+        sys.exit(1)
+    intervalo_heartbeat = opcoes.get("heartbeat", str(INTERVALO_HEARTBEAT))
+    if not intervalo_heartbeat.isdigit():
+        print(f"Erro: intervalo de heartbeat inválido '{intervalo_heartbeat}'.")
+        sys.exit(1)
+    intervalo_heartbeat = int(intervalo_heartbeat)
+    intervalo_anti_entropia = opcoes.get("anti-entropia", str(INTERVALO_ANTI_ENTROPIA))
+    if not intervalo_anti_entropia.isdigit():
+        print(f"Erro: intervalo de anti-entropia inválido '{intervalo_anti_entropia}'.")
+        sys.exit(1)
+    intervalo_anti_entropia = int(intervalo_anti_entropia)
+
     if not os.path.isdir(diretorio):
         print("Erro: diretório inválido.")
         sys.exit(1)
 
-    clock = Clock()
-    lista_vizinhos = inicializar_vizinhos(vizinhos_path)
+    clock = Clock(SaidaAssincrona().registrar)
+    hlc = RelogioHibrido() if modo_relogio == "hlc" else None
+    lista_vizinhos = inicializar_vizinhos(vizinhos_path, armazenamento_peers == "compacto", hlc)
     servidor = configurar_socket(endereco_porta)
-    threading.Thread(target=aceitar_conexoes, args=(servidor, clock, lista_vizinhos, diretorio), daemon=True).start()
-    menu(lista_vizinhos, endereco_porta, clock, diretorio, servidor)
+    indice_arquivos = IndiceArquivos(diretorio)
+    threading.Thread(target=indice_arquivos.monitorar, daemon=True).start()
+    threading.Thread(target=indice_arquivos.manifestos.monitorar, daemon=True).start()
+    pool = PoolConexoes(binario=protocolo == "binario", endereco_porta=endereco_porta, clock=clock)
+    inundacao = BuscaInundacao(endereco_porta, clock, lista_vizinhos, indice_arquivos, pool)
+    iniciar_servidor(servidor, modo_servidor, clock, lista_vizinhos, indice_arquivos, inundacao)
+    if intervalo_heartbeat > 0:
+        detector = DetectorFalhas(lista_vizinhos, endereco_porta, clock, pool, intervalo_heartbeat)
+        threading.Thread(target=detector.monitorar, daemon=True).start()
+    if intervalo_anti_entropia > 0:
+        anti_entropia = AntiEntropia(lista_vizinhos, endereco_porta, clock, pool, intervalo_anti_entropia)
+        threading.Thread(target=anti_entropia.monitorar, daemon=True).start()
+    menu(lista_vizinhos, endereco_porta, clock, indice_arquivos, servidor, pool, CacheBusca(lista_vizinhos), inundacao, IndiceResultados(lista_vizinhos))